@@ -1,9 +1,19 @@
-from collections import namedtuple
+from array import array
+from collections import defaultdict, namedtuple
 import math
+import multiprocessing
+import os
+import pickle
 
 Point = "Dict[str, float]"
 
+# Opcodes used by the flattened `Graph` representation
+(VARIABLE, CONSTANT, ADD, SUBTRACT, MULTIPLY, DIVIDE, POW, POW_CONST,
+ MUL_ADD, SUM, EXP, LOG, SIN, COS, TANH, SQRT) = range(16)
+
 class Expr:
+    __slots__ = ()
+
     def eval(self, point: Point) -> float:
         """ Evaluate the expr @ the given point.
 
@@ -54,6 +64,14 @@ class Expr:
                       gradient: Point, cache):
         raise NotImplementedError
 
+    def _children(self):
+        """ The subexpressions this expr is computed from """
+        return tuple(self)
+
+    def compile(self) -> "Graph":
+        """ Flatten this expression into an array-backed `Graph` """
+        return Graph(self)
+
     def __add__(self, other):
         return Add(self, other)
 
@@ -67,9 +85,14 @@ class Expr:
         return Divide(self, other)
 
     def __pow__(self, other):
+        if isinstance(other, Constant):
+            return PowConst(self, other.value)
         return Pow(self, other)
 
 class Variable(Expr, namedtuple("Variable", ["name"])):
+    __slots__ = ()
+    opcode = VARIABLE
+
     def _eval(self, point, cache):
         cache[id(self)] = point[self.name]
         return point[self.name]
@@ -80,7 +103,13 @@ class Variable(Expr, namedtuple("Variable", ["name"])):
     def _reverse_diff(self, point, adjoint, gradient, cache):
         gradient[self.name] += adjoint
 
+    def _children(self):
+        return ()
+
 class Constant(Expr, namedtuple("Constant", ["value"])):
+    __slots__ = ()
+    opcode = CONSTANT
+
     def _eval(self, point, cache):
         cache[id(self)] = self.value
         return self.value
@@ -91,7 +120,13 @@ class Constant(Expr, namedtuple("Constant", ["value"])):
     def _reverse_diff(self, point, ajoint, gradient, cache):
         pass
 
+    def _children(self):
+        return ()
+
 class Add(Expr, namedtuple("Add", ["expr1", "expr2"])):
+    __slots__ = ()
+    opcode = ADD
+
     def _eval(self, point, cache):
         if id(self) not in cache:
             eval1, eval2 = self.expr1._eval, self.expr2._eval
@@ -107,6 +142,9 @@ class Add(Expr, namedtuple("Add", ["expr1", "expr2"])):
         self.expr2._reverse_diff(point, adjoint, gradient, cache)
 
 class Subtract(Expr, namedtuple("Subtract", ["expr1", "expr2"])):
+    __slots__ = ()
+    opcode = SUBTRACT
+
     def _eval(self, point, cache):
         if id(self) not in cache:
             eval1, eval2 = self.expr1._eval, self.expr2._eval
@@ -122,6 +160,9 @@ class Subtract(Expr, namedtuple("Subtract", ["expr1", "expr2"])):
         self.expr2._reverse_diff(point, -adjoint, gradient, cache)
 
 class Multiply(Expr, namedtuple("Multiply", ["expr1", "expr2"])):
+    __slots__ = ()
+    opcode = MULTIPLY
+
     def _eval(self, point, cache):
         if id(self) not in cache:
             eval1, eval2 = self.expr1._eval, self.expr2._eval
@@ -142,6 +183,9 @@ class Multiply(Expr, namedtuple("Multiply", ["expr1", "expr2"])):
         self.expr2._reverse_diff(point, adjoint * lhs, gradient, cache)
 
 class Divide(Expr, namedtuple("Divide", ["expr1", "expr2"])):
+    __slots__ = ()
+    opcode = DIVIDE
+
     def _eval(self, point, cache):
         if id(self) not in cache:
             eval1, eval2 = self.expr1._eval, self.expr2._eval
@@ -164,6 +208,9 @@ class Divide(Expr, namedtuple("Divide", ["expr1", "expr2"])):
                                  cache)
 
 class Pow(Expr, namedtuple("Pow", ["expr1", "expr2"])):
+    __slots__ = ()
+    opcode = POW
+
     def _eval(self, point, cache):
         if id(self) not in cache:
             eval1, eval2 = self.expr1._eval, self.expr2._eval
@@ -192,5 +239,697 @@ class Pow(Expr, namedtuple("Pow", ["expr1", "expr2"])):
 
         self.expr1._reverse_diff(point, adjoint * exp * base ** (exp - 1),
                                  gradient, cache)
-        self.expr2._reverse_diff(point, adjoint * math.log(base) * base ** exp,
-                                 gradient, cache)
+        if not isinstance(self.expr2, Constant):
+            self.expr2._reverse_diff(point,
+                                     adjoint * math.log(base) * base ** exp,
+                                     gradient, cache)
+
+class PowConst(Expr, namedtuple("PowConst", ["expr", "exponent"])):
+    """ expr ** exponent, for a fixed (numeric) exponent """
+    __slots__ = ()
+    opcode = POW_CONST
+
+    def _eval(self, point, cache):
+        if id(self) not in cache:
+            cache[id(self)] = self.expr._eval(point, cache) ** self.exponent
+        return cache[id(self)]
+
+    def _derivative(self, base):
+        if self.exponent == 0:
+            return 0
+        return self.exponent * base ** (self.exponent - 1)
+
+    def _forward_diff(self, direction, point, cache):
+        base = cache[id(self.expr)]
+        return (self._derivative(base) *
+                self.expr._forward_diff(direction, point, cache))
+
+    def _reverse_diff(self, point, adjoint, gradient, cache):
+        base = cache[id(self.expr)]
+        self.expr._reverse_diff(point, adjoint * self._derivative(base),
+                                gradient, cache)
+
+    def _children(self):
+        return (self.expr,)
+
+class MulAdd(Expr, namedtuple("MulAdd", ["expr1", "expr2", "expr3"])):
+    """ expr1 * expr2 + expr3, as a single node """
+    __slots__ = ()
+    opcode = MUL_ADD
+
+    def _eval(self, point, cache):
+        if id(self) not in cache:
+            cache[id(self)] = (self.expr1._eval(point, cache) *
+                               self.expr2._eval(point, cache) +
+                               self.expr3._eval(point, cache))
+        return cache[id(self)]
+
+    def _forward_diff(self, direction, point, cache):
+        lhs = cache[id(self.expr1)]
+        rhs = cache[id(self.expr2)]
+        return (rhs * self.expr1._forward_diff(direction, point, cache) +
+                lhs * self.expr2._forward_diff(direction, point, cache) +
+                self.expr3._forward_diff(direction, point, cache))
+
+    def _reverse_diff(self, point, adjoint, gradient, cache):
+        lhs = cache[id(self.expr1)]
+        rhs = cache[id(self.expr2)]
+        self.expr1._reverse_diff(point, adjoint * rhs, gradient, cache)
+        self.expr2._reverse_diff(point, adjoint * lhs, gradient, cache)
+        self.expr3._reverse_diff(point, adjoint, gradient, cache)
+
+class Sum(Expr, namedtuple("Sum", ["exprs"])):
+    """ The sum of any number of exprs, as a single node """
+    __slots__ = ()
+    opcode = SUM
+
+    def __new__(cls, exprs):
+        return super().__new__(cls, tuple(exprs))
+
+    def _eval(self, point, cache):
+        if id(self) not in cache:
+            cache[id(self)] = sum(expr._eval(point, cache)
+                                  for expr in self.exprs)
+        return cache[id(self)]
+
+    def _forward_diff(self, direction, point, cache):
+        return sum(expr._forward_diff(direction, point, cache)
+                   for expr in self.exprs)
+
+    def _reverse_diff(self, point, adjoint, gradient, cache):
+        for expr in self.exprs:
+            expr._reverse_diff(point, adjoint, gradient, cache)
+
+    def _children(self):
+        return self.exprs
+
+class Unary(Expr):
+    """ Base class for elementwise functions of a single expr.
+
+    Subclasses provide `function(x)` and `derivative(x, fx)`, where `fx` is
+    `function(x)` (so e.g. Exp can reuse its value).
+    """
+    __slots__ = ()
+
+    def _eval(self, point, cache):
+        if id(self) not in cache:
+            cache[id(self)] = self.function(self.expr._eval(point, cache))
+        return cache[id(self)]
+
+    def _forward_diff(self, direction, point, cache):
+        x = cache[id(self.expr)]
+        return (self.derivative(x, cache[id(self)]) *
+                self.expr._forward_diff(direction, point, cache))
+
+    def _reverse_diff(self, point, adjoint, gradient, cache):
+        x = cache[id(self.expr)]
+        self.expr._reverse_diff(point,
+                                adjoint * self.derivative(x, cache[id(self)]),
+                                gradient, cache)
+
+class Exp(Unary, namedtuple("Exp", ["expr"])):
+    __slots__ = ()
+    opcode = EXP
+    function = staticmethod(math.exp)
+
+    @staticmethod
+    def derivative(x, fx):
+        return fx
+
+class Log(Unary, namedtuple("Log", ["expr"])):
+    __slots__ = ()
+    opcode = LOG
+    function = staticmethod(math.log)
+
+    @staticmethod
+    def derivative(x, fx):
+        return 1 / x
+
+class Sin(Unary, namedtuple("Sin", ["expr"])):
+    __slots__ = ()
+    opcode = SIN
+    function = staticmethod(math.sin)
+
+    @staticmethod
+    def derivative(x, fx):
+        return math.cos(x)
+
+class Cos(Unary, namedtuple("Cos", ["expr"])):
+    __slots__ = ()
+    opcode = COS
+    function = staticmethod(math.cos)
+
+    @staticmethod
+    def derivative(x, fx):
+        return -math.sin(x)
+
+class Tanh(Unary, namedtuple("Tanh", ["expr"])):
+    __slots__ = ()
+    opcode = TANH
+    function = staticmethod(math.tanh)
+
+    @staticmethod
+    def derivative(x, fx):
+        return 1 - fx * fx
+
+class Sqrt(Unary, namedtuple("Sqrt", ["expr"])):
+    __slots__ = ()
+    opcode = SQRT
+    function = staticmethod(math.sqrt)
+
+    @staticmethod
+    def derivative(x, fx):
+        return 0.5 / fx
+
+
+# Unary node classes, by opcode
+UNARY = {cls.opcode: cls for cls in (Exp, Log, Sin, Cos, Tanh, Sqrt)}
+
+
+class Graph:
+    """ An expression DAG flattened into parallel arrays.
+
+    Nodes are numbered in topological order (children before parents), so
+    evaluation is one forward loop over the arrays and reverse-mode
+    differentiation is one backward loop. Shared subexpressions (and
+    Variables with the same name) become a single node.
+
+    `ops[i]` is the opcode of node i, its children are
+    `children[offsets[i]:offsets[i + 1]]` and `consts[i]` holds its value if
+    it is a Constant (or its exponent if it is a PowConst). `values` and
+    `adjoints` are scratch arrays filled in by `eval` and `reverse_diff`,
+    allocated the first time they are used.
+    """
+    def __init__(self, expr: Expr):
+        self.ops = array("B")
+        self.offsets = array("l", [0])
+        self.children = array("l")
+        self.consts = array("d")
+        self.names = []             # variable names
+        self.variables = array("l")  # node index of each variable name
+
+        index = {}
+        by_name = {}
+        # iterative post-order traversal, so deep graphs don't hit the
+        # recursion limit
+        stack = [(expr, False)]
+        while stack:
+            node, expanded = stack.pop()
+            if id(node) in index:
+                continue
+            if node.opcode == VARIABLE and node.name in by_name:
+                index[id(node)] = by_name[node.name]
+                continue
+
+            args = node._children()
+            if args and not expanded:
+                stack.append((node, True))
+                stack.extend((arg, False) for arg in reversed(args)
+                             if id(arg) not in index)
+                continue
+
+            i = len(self.ops)
+            index[id(node)] = i
+            self.ops.append(node.opcode)
+            self.children.extend(index[id(arg)] for arg in args)
+            self.offsets.append(len(self.children))
+            if node.opcode == CONSTANT:
+                self.consts.append(node.value)
+            elif node.opcode == POW_CONST:
+                self.consts.append(node.exponent)
+            else:
+                self.consts.append(0)
+            if node.opcode == VARIABLE:
+                by_name[node.name] = i
+                self.names.append(node.name)
+                self.variables.append(i)
+
+        self._values = None
+        self._adjoints = None
+
+    def __len__(self):
+        return len(self.ops)
+
+    def __getstate__(self):
+        # don't bother shipping the scratch arrays
+        state = dict(self.__dict__)
+        state["_values"] = state["_adjoints"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    @property
+    def values(self):
+        if self._values is None:
+            self._values = array("d", [0]) * len(self.ops)
+        return self._values
+
+    @property
+    def adjoints(self):
+        if self._adjoints is None:
+            self._adjoints = array("d", [0]) * len(self.ops)
+        return self._adjoints
+
+    def eval(self, point: Point) -> float:
+        """ Evaluate the graph @ the given point, filling in `values`.
+
+        :param point: Dict[str, float]. Maps variable names to their value
+        :returns float:
+        """
+        for name, i in zip(self.names, self.variables):
+            self.values[i] = point[name]
+        self._forward(range(len(self.ops)))
+        return self.values[-1]
+
+    def _forward(self, nodes, values=None):
+        """ Recompute `values` for the given node indices, in order.
+
+        `values` defaults to `self.values`, but can be any mapping from node
+        index to value that holds the nodes' children.
+        """
+        ops, offsets, children = self.ops, self.offsets, self.children
+        consts = self.consts
+        if values is None:
+            values = self.values
+
+        for i in nodes:
+            op = ops[i]
+            if op == VARIABLE:
+                continue
+            elif op == CONSTANT:
+                values[i] = consts[i]
+                continue
+
+            start = offsets[i]
+            if op in UNARY:
+                values[i] = UNARY[op].function(values[children[start]])
+                continue
+            elif op == POW_CONST:
+                values[i] = values[children[start]] ** consts[i]
+                continue
+            elif op == SUM:
+                values[i] = sum(values[child]
+                                for child in children[start:offsets[i + 1]])
+                continue
+
+            lhs = values[children[start]]
+            rhs = values[children[start + 1]]
+            if op == ADD:
+                values[i] = lhs + rhs
+            elif op == SUBTRACT:
+                values[i] = lhs - rhs
+            elif op == MULTIPLY:
+                values[i] = lhs * rhs
+            elif op == DIVIDE:
+                values[i] = lhs / rhs
+            elif op == POW:
+                values[i] = lhs ** rhs
+            elif op == MUL_ADD:
+                values[i] = lhs * rhs + values[children[start + 2]]
+
+    def forward_diff(self, direction: Point, point: Point) -> float:
+        """ Evaulate the directional derivative of a direction @ a point via
+        forward-mode automatic differentiation
+
+        :param point: Dict[str, float]. Maps variable names to their value
+        :param direction: Dict[str, float]. Maps variable names to their value
+        :returns float:
+        """
+        self.eval(point)
+        ops, offsets, children = self.ops, self.offsets, self.children
+        values, consts = self.values, self.consts
+        tangents = array("d", [0]) * len(ops)
+
+        for name, i in zip(self.names, self.variables):
+            tangents[i] = direction[name]
+
+        for i, op in enumerate(ops):
+            if op in (VARIABLE, CONSTANT):
+                continue
+
+            start = offsets[i]
+            if op in UNARY:
+                child = children[start]
+                tangents[i] = (UNARY[op].derivative(values[child], values[i]) *
+                               tangents[child])
+                continue
+            elif op == POW_CONST:
+                child = children[start]
+                if consts[i] != 0:
+                    tangents[i] = (consts[i] *
+                                   values[child] ** (consts[i] - 1) *
+                                   tangents[child])
+                continue
+            elif op == SUM:
+                tangents[i] = sum(tangents[child]
+                                  for child in children[start:offsets[i + 1]])
+                continue
+
+            l, r = children[start], children[start + 1]
+            lhs, rhs = values[l], values[r]
+            dlhs, drhs = tangents[l], tangents[r]
+            if op == ADD:
+                tangents[i] = dlhs + drhs
+            elif op == SUBTRACT:
+                tangents[i] = dlhs - drhs
+            elif op == MULTIPLY:
+                tangents[i] = rhs * dlhs + lhs * drhs
+            elif op == DIVIDE:
+                tangents[i] = (rhs * dlhs - lhs * drhs) / rhs ** 2
+            elif op == POW:
+                if lhs == 0:    # avoid MathDomainError
+                    tangents[i] = 0
+                else:
+                    tangents[i] = (lhs ** (rhs - 1) *
+                                   (rhs * dlhs + lhs * drhs * math.log(lhs)))
+            elif op == MUL_ADD:
+                tangents[i] = (rhs * dlhs + lhs * drhs +
+                               tangents[children[start + 2]])
+        return tangents[-1]
+
+    def reverse_diff(self, point: Point, segment: int = None) -> Point:
+        """ Evaulate the gradient of a direction @ a point via
+        reverse-mode automatic differentiation, filling in `adjoints`.
+
+        :param point: Dict[str, float]. Maps variable names to their value
+        :param segment: If given, use `checkpointed_reverse_diff` with
+            segments of this many nodes instead.
+        :returns Dict[str, float]: Returns gradient @ point
+        """
+        if segment is not None:
+            return self.checkpointed_reverse_diff(point, segment)
+
+        self.eval(point)
+        self.adjoints[:] = array("d", [0]) * len(self.adjoints)
+        self.adjoints[-1] = 1
+        self._backward(range(len(self.ops)))
+
+        gradient = {key: 0 for key in point}
+        for name, i in zip(self.names, self.variables):
+            gradient[name] += self.adjoints[i]
+        return gradient
+
+    def _backward(self, nodes, values=None, adjoints=None):
+        """ Accumulate `adjoints` by sweeping backwards over the given node
+        indices (in topological order). Nodes left out are assumed not to
+        lead to any Variable.
+
+        `values` and `adjoints` default to `self.values` and `self.adjoints`;
+        the adjoints of `nodes` must already be initialized.
+        """
+        ops, offsets, children = self.ops, self.offsets, self.children
+        consts = self.consts
+        if values is None:
+            values = self.values
+        if adjoints is None:
+            adjoints = self.adjoints
+
+        for i in reversed(nodes):
+            op = ops[i]
+            if op in (VARIABLE, CONSTANT):
+                continue
+
+            adjoint = adjoints[i]
+            start = offsets[i]
+            if op in UNARY:
+                child = children[start]
+                adjoints[child] += (
+                    adjoint * UNARY[op].derivative(values[child], values[i]))
+                continue
+            elif op == POW_CONST:
+                child = children[start]
+                if consts[i] != 0:
+                    adjoints[child] += (adjoint * consts[i] *
+                                        values[child] ** (consts[i] - 1))
+                continue
+            elif op == SUM:
+                for child in children[start:offsets[i + 1]]:
+                    adjoints[child] += adjoint
+                continue
+
+            l, r = children[start], children[start + 1]
+            lhs, rhs = values[l], values[r]
+            if op == ADD:
+                adjoints[l] += adjoint
+                adjoints[r] += adjoint
+            elif op == SUBTRACT:
+                adjoints[l] += adjoint
+                adjoints[r] -= adjoint
+            elif op == MULTIPLY:
+                adjoints[l] += adjoint * rhs
+                adjoints[r] += adjoint * lhs
+            elif op == DIVIDE:
+                adjoints[l] += adjoint / rhs
+                adjoints[r] -= adjoint * lhs / rhs ** 2
+            elif op == POW:
+                adjoints[l] += adjoint * rhs * lhs ** (rhs - 1)
+                if ops[r] != CONSTANT:
+                    adjoints[r] += adjoint * math.log(lhs) * values[i]
+            elif op == MUL_ADD:
+                adjoints[l] += adjoint * rhs
+                adjoints[r] += adjoint * lhs
+                adjoints[children[start + 2]] += adjoint
+
+    def checkpointed_reverse_diff(self, point: Point, segment: int) -> Point:
+        """ Reverse-mode automatic differentiation in bounded memory.
+
+        The nodes are split into segments of `segment` consecutive nodes. The
+        forward sweep only keeps the values that later segments read (the
+        checkpoints), and the backward sweep recomputes each segment from
+        those before differentiating through it. This costs one extra
+        forward sweep, but only holds O(segment + checkpoints) values and
+        adjoints at once instead of O(len(graph)). Smaller segments mean
+        less to recompute at once, but usually more checkpoints.
+
+        Doesn't use (or allocate) the `values` and `adjoints` scratch
+        arrays.
+
+        :param point: Dict[str, float]. Maps variable names to their value
+        :param segment: int. Number of nodes per segment, at least 1
+        :returns Dict[str, float]: Returns gradient @ point
+        """
+        if segment < 1:
+            raise ValueError(
+                "segment must be at least 1, not {!r}".format(segment))
+        n = len(self.ops)
+        checkpoints = self._checkpoints(segment)
+        variables = {i: point[name]
+                     for name, i in zip(self.names, self.variables)}
+        starts = range(0, n, segment)
+
+        saved = {}
+        for start in starts[:-1]:
+            stop = start + segment
+            values = self._segment_values(start, stop, saved, variables)
+            for i in range(start, stop):
+                if i in checkpoints:
+                    saved[i] = values[i]
+
+        adjoints = defaultdict(float)
+        adjoints[n - 1] = 1
+        gradient = {key: 0 for key in point}
+        names = dict(zip(self.variables, self.names))
+        for start in reversed(starts):
+            stop = min(start + segment, n)
+            values = self._segment_values(start, stop, saved, variables)
+            self._backward(range(start, stop), values, adjoints)
+            for i in range(start, stop):
+                saved.pop(i, None)
+                adjoint = adjoints.pop(i, 0)
+                if i in names:
+                    gradient[names[i]] += adjoint
+        return gradient
+
+    def _segment_values(self, start, stop, saved, variables):
+        """ Compute the values of nodes start...stop - 1 from the values of
+        the earlier nodes they read, which must be in `saved` """
+        ops, offsets, children = self.ops, self.offsets, self.children
+        values = {}
+        for i in range(start, stop):
+            if ops[i] == VARIABLE:
+                values[i] = variables[i]
+            for child in children[offsets[i]:offsets[i + 1]]:
+                if child < start:
+                    values[child] = saved[child]
+        self._forward(range(start, stop), values)
+        return values
+
+    def _checkpoints(self, segment):
+        """ The set of nodes read by some node in a later segment """
+        offsets, children = self.offsets, self.children
+        checkpoints = set()
+        for i in range(len(self.ops)):
+            start = i - i % segment
+            for child in children[offsets[i]:offsets[i + 1]]:
+                if child < start:
+                    checkpoints.add(child)
+        return checkpoints
+
+
+# The Graph each `parallel_reverse_diff` worker process differentiates
+_worker_graph = None
+
+def _init_worker(data):
+    global _worker_graph
+    _worker_graph = pickle.loads(data)
+
+def _worker_reverse_diff(points):
+    return _reverse_diffs(_worker_graph, points)
+
+def _reverse_diffs(graph, points):
+    """ The gradient of graph @ each of points, shaped like the points """
+    gradients = []
+    for point in points:
+        if isinstance(point, dict):
+            gradients.append(graph.reverse_diff(point))
+        else:
+            gradient = graph.reverse_diff(dict(zip(graph.names, point)))
+            gradients.append([gradient[name] for name in graph.names])
+    return gradients
+
+def parallel_reverse_diff(graph: Graph, points, processes=None,
+                          chunksize=None):
+    """ Evaluate the gradient of `graph` @ many points in a process pool.
+
+    The graph is pickled once and unpickled once per worker; points are sent
+    in chunks to amortize the IPC.
+
+    :param graph: Graph (or Expr, which is compiled first)
+    :param points: Either a list of Dict[str, float], or a sequence of rows
+        of values ordered like `graph.names`
+    :param processes: number of worker processes (defaults to CPU count).
+        With one, or no points, the gradients are computed in this process
+    :param chunksize: number of points per task (defaults to splitting the
+        points into ~4 chunks per process)
+    :returns: A list of gradients, as dicts for dict points and lists
+        ordered like `graph.names` otherwise
+    """
+    if isinstance(graph, Expr):
+        graph = graph.compile()
+    points = list(points)
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if not points or processes == 1:
+        return _reverse_diffs(graph, points)
+    if chunksize is None:
+        chunksize = max(1, -(-len(points) // (4 * processes)))
+
+    chunks = [points[i:i + chunksize]
+              for i in range(0, len(points), chunksize)]
+    data = pickle.dumps(graph, pickle.HIGHEST_PROTOCOL)
+    with multiprocessing.Pool(processes, _init_worker, (data,)) as pool:
+        results = pool.map(_worker_reverse_diff, chunks, chunksize=1)
+    return [gradient for chunk in results for gradient in chunk]
+
+
+class EvalContext:
+    """ A persistent evaluation of a `Graph` across many points.
+
+    Remembers the value of every node and, for every node, the nodes that
+    directly use it (its fan-out). When only a few variables change between
+    calls, only the nodes that depend on them (the "dirty cone") are
+    recomputed.
+
+    Adjoints can't be patched the same way -- the root depends on every
+    changed variable, so a change anywhere alters the adjoint of everything
+    below it -- but the backward sweep is restricted to nodes that lead to
+    some Variable, and is skipped entirely if nothing changed.
+
+    The context keeps its own `values` and `adjoints`, so using the graph
+    directly (or through another context) doesn't disturb it.
+    """
+    def __init__(self, graph: Graph):
+        if isinstance(graph, Expr):
+            graph = graph.compile()
+        self.graph = graph
+        self.point = None
+        self.recomputed = 0     # nodes recomputed by the last `eval`
+        self._gradient = None
+
+        n = len(graph)
+        self.values = array("d", [0]) * n
+        self.adjoints = array("d", [0]) * n
+        counts = array("l", [0]) * (n + 1)
+        for child in graph.children:
+            counts[child + 1] += 1
+        for i in range(n):
+            counts[i + 1] += counts[i]
+
+        # CSR layout again: parents of node i are
+        # parents[parent_offsets[i]:parent_offsets[i + 1]]
+        self.parent_offsets = array("l", counts)
+        self.parents = array("l", [0]) * len(graph.children)
+        for i in range(n):
+            for j in range(graph.offsets[i], graph.offsets[i + 1]):
+                child = graph.children[j]
+                self.parents[counts[child]] = i
+                counts[child] += 1
+
+        self.active = self._cone(graph.variables)
+
+    def _cone(self, nodes):
+        """ All nodes that (transitively) use one of `nodes`, in
+        topological order """
+        parents, offsets = self.parents, self.parent_offsets
+        seen = set(nodes)
+        stack = list(nodes)
+        while stack:
+            i = stack.pop()
+            for j in range(offsets[i], offsets[i + 1]):
+                parent = parents[j]
+                if parent not in seen:
+                    seen.add(parent)
+                    stack.append(parent)
+        return sorted(seen)
+
+    def eval(self, point: Point) -> float:
+        """ Evaluate the graph @ the given point, only recomputing nodes
+        that depend on a variable whose value changed since the last call.
+
+        :param point: Dict[str, float]. Maps variable names to their value
+        :returns float:
+        """
+        graph, values = self.graph, self.values
+        if self.point is None:
+            for name, i in zip(graph.names, graph.variables):
+                values[i] = point[name]
+            graph._forward(range(len(graph)), values)
+            self.recomputed = len(graph)
+            self._gradient = None
+        else:
+            dirty = []
+            for name, i in zip(graph.names, graph.variables):
+                if point[name] != self.point[name]:
+                    values[i] = point[name]
+                    dirty.append(i)
+            cone = self._cone(dirty) if dirty else []
+            graph._forward(cone, values)
+            self.recomputed = len(cone)
+            if dirty:
+                self._gradient = None
+
+        self.point = {name: point[name] for name in graph.names}
+        return values[-1]
+
+    def reverse_diff(self, point: Point) -> Point:
+        """ Evaulate the gradient of a direction @ a point via
+        reverse-mode automatic differentiation, reusing the previous
+        results where possible.
+
+        :param point: Dict[str, float]. Maps variable names to their value
+        :returns Dict[str, float]: Returns gradient @ point
+        """
+        graph = self.graph
+        self.eval(point)
+        if self._gradient is None:
+            adjoints = self.adjoints
+            adjoints[:] = array("d", [0]) * len(graph)
+            adjoints[-1] = 1
+            graph._backward(self.active, self.values, adjoints)
+            self._gradient = {name: adjoints[i]
+                              for name, i in zip(graph.names, graph.variables)}
+
+        gradient = {key: 0 for key in point}
+        gradient.update(self._gradient)
+        return gradient
@@ -0,0 +1,76 @@
+""" Benchmarks for autodiff. Run with `python bench.py`. """
+import os
+import random
+import time
+import tracemalloc
+
+import autodiff
+
+
+def random_expr(n_vars=10, n_nodes=2000, seed=0):
+    """ A random DAG with `n_nodes` arithmetic nodes over `n_vars` vars """
+    rng = random.Random(seed)
+    nodes = [autodiff.Variable("x{}".format(i)) for i in range(n_vars)]
+    ops = [autodiff.Add, autodiff.Subtract, autodiff.Multiply]
+    for _ in range(n_nodes):
+        op = rng.choice(ops)
+        nodes.append(op(rng.choice(nodes[-50:]), rng.choice(nodes)))
+    return autodiff.Tanh(nodes[-1] * autodiff.Constant(1e-3))
+
+
+def bench_parallel(n_points=4000):
+    graph = random_expr().compile()
+    rng = random.Random(1)
+    points = [{name: rng.uniform(-1, 1) for name in graph.names}
+              for _ in range(n_points)]
+
+    print("parallel_reverse_diff: {} points, {} nodes".format(
+        n_points, len(graph)))
+    start = time.perf_counter()
+    for point in points:
+        graph.reverse_diff(point)
+    serial = time.perf_counter() - start
+    print("  serial:    {:.2f}s".format(serial))
+
+    processes = 1
+    while processes <= (os.cpu_count() or 1):
+        start = time.perf_counter()
+        autodiff.parallel_reverse_diff(graph, points, processes=processes)
+        elapsed = time.perf_counter() - start
+        print("  {:2} procs: {:.2f}s ({:.1f}x)".format(
+            processes, elapsed, serial / elapsed))
+        processes *= 2
+
+
+def unrolled_expr(steps=50000):
+    """ An unrolled recurrence h = tanh(w * h + b), like an RNN """
+    w = autodiff.Variable("w")
+    b = autodiff.Variable("b")
+    h = autodiff.Variable("h0")
+    for _ in range(steps):
+        h = autodiff.Tanh(autodiff.MulAdd(w, h, b))
+    return h
+
+
+def bench_checkpoint():
+    graph = unrolled_expr().compile()
+    point = {"w": 0.5, "b": 0.1, "h0": 0.0}
+
+    print("checkpointed_reverse_diff: {} nodes".format(len(graph)))
+    for segment in [None, 10000, 1000, 100, 10]:
+        # drop the scratch arrays, so every row counts what it allocates
+        graph._values = graph._adjoints = None
+        tracemalloc.start()
+        start = time.perf_counter()
+        graph.reverse_diff(point, segment=segment)
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        print("  segment={!s:>5}: {:.2f}s, peak {:.0f} KiB".format(
+            segment, elapsed, peak / 1024))
+
+
+if __name__ == "__main__":
+    bench_parallel()
+    bench_checkpoint()
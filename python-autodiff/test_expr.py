@@ -118,3 +118,165 @@ def test_reverse_diff3(point):
     x, y = point["x"], point["y"]
     assert expr.reverse_diff(point) == {"x": y * x ** (y - 1),
                                         "y": math.log(x) * x ** y}
+
+@pytest.mark.parametrize("point", points)
+def test_graph(point):
+    x = autodiff.Variable('x')
+    y = autodiff.Variable('y')
+
+    exprs = [x * y + x / y, x * x * y - x * y * y, x ** y,
+             (x + autodiff.Constant(10)) / (x * autodiff.Variable('x'))]
+    for expr in exprs:
+        graph = expr.compile()
+        assert graph.eval(point) == pytest.approx(expr.eval(point))
+        assert (graph.forward_diff({"x": 1, "y": 0}, point) ==
+                pytest.approx(expr.forward_diff({"x": 1, "y": 0}, point)))
+
+        gradient = graph.reverse_diff(point)
+        expected = expr.reverse_diff(point)
+        assert gradient.keys() == expected.keys()
+        for key in expected:
+            assert gradient[key] == pytest.approx(expected[key])
+
+def test_graph_shares_nodes():
+    x = autodiff.Variable('x')
+    expr = x
+    for _ in range(10000):
+        expr = expr + x
+
+    # one node for x, and one per Add
+    graph = expr.compile()
+    assert len(graph) == 10001
+    assert graph.eval({"x": 2}) == 20002
+    assert graph.reverse_diff({"x": 2}) == {"x": 10001}
+
+    y = x * x
+    assert len((y + y).compile()) == 3
+
+def test_eval_context():
+    x = autodiff.Variable('x')
+    y = autodiff.Variable('y')
+    z = autodiff.Variable('z')
+    expr = (x * y + x / y) * (z + autodiff.Constant(1))
+
+    context = autodiff.EvalContext(expr)
+    for point in points:
+        point = dict(point, z=2)
+        assert context.eval(point) == pytest.approx(expr.eval(point))
+        gradient = context.reverse_diff(point)
+        expected = expr.reverse_diff(point)
+        for key in expected:
+            assert gradient[key] == pytest.approx(expected[key])
+
+    # only z, z + 1 and the root depend on z
+    context.eval({"x": 13.4, "y": 0.2, "z": 3})
+    assert context.recomputed == 3
+    context.eval({"x": 13.4, "y": 0.2, "z": 3})
+    assert context.recomputed == 0
+    point = {"x": 13.4, "y": 0.2, "z": 3}
+    expected = expr.reverse_diff(point)
+    assert context.reverse_diff(point) == pytest.approx(expected)
+
+def test_eval_context_shared_graph():
+    x = autodiff.Variable('x')
+    y = autodiff.Variable('y')
+    graph = (x * y).compile()
+    point = {"x": 1, "y": 2}
+
+    context = autodiff.EvalContext(graph)
+    other = autodiff.EvalContext(graph)
+    assert context.eval(point) == 2
+    assert graph.eval({"x": 5, "y": 5}) == 25
+    assert graph.reverse_diff({"x": 5, "y": 5}) == {"x": 5, "y": 5}
+    assert other.eval({"x": 3, "y": 3}) == 9
+    assert context.eval(point) == 2
+    assert context.reverse_diff(point) == {"x": 2, "y": 1}
+    assert other.reverse_diff({"x": 3, "y": 3}) == {"x": 3, "y": 3}
+
+
+unary = [(autodiff.Exp, math.exp, math.exp),
+         (autodiff.Log, math.log, lambda x: 1 / x),
+         (autodiff.Sin, math.sin, math.cos),
+         (autodiff.Cos, math.cos, lambda x: -math.sin(x)),
+         (autodiff.Tanh, math.tanh, lambda x: 1 - math.tanh(x) ** 2),
+         (autodiff.Sqrt, math.sqrt, lambda x: 0.5 / math.sqrt(x))]
+
+@pytest.mark.parametrize("cls,f,df", unary)
+@pytest.mark.parametrize("x", [0.5, 1, 13.4])
+def test_unary(cls, f, df, x):
+    expr = cls(autodiff.Variable('x') * autodiff.Constant(2))
+    point = {"x": x}
+    for e in [expr, expr.compile()]:
+        assert e.eval(point) == pytest.approx(f(2 * x))
+        assert e.forward_diff({"x": 1}, point) == pytest.approx(2 * df(2 * x))
+        assert e.reverse_diff(point)["x"] == pytest.approx(2 * df(2 * x))
+
+@pytest.mark.parametrize("point", points)
+def test_fused(point):
+    x = autodiff.Variable('x')
+    y = autodiff.Variable('y')
+
+    pow_const = x ** autodiff.Constant(3)
+    assert isinstance(pow_const, autodiff.PowConst)
+    muladd = autodiff.MulAdd(x, y, pow_const)
+    total = autodiff.Sum([x, y, muladd, x])
+
+    x, y = point["x"], point["y"]
+    for e in [total, total.compile()]:
+        assert e.eval(point) == pytest.approx(2 * x + y + x * y + x ** 3)
+        dx = e.forward_diff({"x": 1, "y": 0}, point)
+        assert dx == pytest.approx(2 + y + 3 * x ** 2)
+        gradient = e.reverse_diff(point)
+        assert gradient["x"] == pytest.approx(2 + y + 3 * x ** 2)
+        assert gradient["y"] == pytest.approx(1 + x)
+
+    # no log(0) for a constant exponent
+    assert pow_const.reverse_diff({"x": 0}) == {"x": 0}
+    graph = (autodiff.Variable('x') ** autodiff.Constant(0)).compile()
+    assert graph.reverse_diff({"x": 0}) == {"x": 0}
+
+def test_parallel_reverse_diff():
+    x = autodiff.Variable('x')
+    y = autodiff.Variable('y')
+    expr = autodiff.Exp(x * y) + x / y
+
+    expected = [expr.reverse_diff(point) for point in points]
+    gradients = autodiff.parallel_reverse_diff(expr, points, processes=2,
+                                               chunksize=2)
+    assert gradients == pytest.approx(expected)
+
+    graph = expr.compile()
+    rows = [[point[name] for name in graph.names] for point in points]
+    gradients = autodiff.parallel_reverse_diff(graph, rows, processes=2)
+    assert gradients == [[g[name] for name in graph.names] for g in expected]
+
+def test_parallel_reverse_diff_in_process(monkeypatch):
+    # no pool for a single process or no points
+    monkeypatch.setattr(autodiff.multiprocessing, "Pool", None)
+    expr = autodiff.Exp(autodiff.Variable('x') * autodiff.Variable('y'))
+    expected = [expr.reverse_diff(point) for point in points]
+    assert autodiff.parallel_reverse_diff(expr, points, processes=1) == \
+        pytest.approx(expected)
+    assert autodiff.parallel_reverse_diff(expr, []) == []
+
+@pytest.mark.parametrize("segment", [1, 2, 5, 1000])
+def test_checkpointed_reverse_diff(segment):
+    x = autodiff.Variable('x')
+    y = autodiff.Variable('y')
+
+    expr = x
+    for i in range(20):
+        expr = autodiff.Sin(expr * y + x) / (y + autodiff.Constant(i))
+    expr = autodiff.MulAdd(expr, x ** autodiff.Constant(2), y)
+
+    graph = expr.compile()
+    for point in points:
+        expected = graph.reverse_diff(point)
+        gradient = graph.reverse_diff(point, segment=segment)
+        assert gradient == pytest.approx(expected)
+
+def test_checkpointed_reverse_diff_segment():
+    graph = (autodiff.Variable('x') * autodiff.Variable('y')).compile()
+    for segment in [0, -1]:
+        with pytest.raises(ValueError, match="segment"):
+            graph.reverse_diff({"x": 1, "y": 2}, segment=segment)
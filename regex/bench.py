@@ -0,0 +1,236 @@
+""" Benchmarks for regex. Run with `python bench.py`. """
+import mmap
+import os
+import random
+import tempfile
+import time
+
+import regex
+
+
+def throughput(f, data, repeat=3):
+    """ Best-of-`repeat` throughput of f(data), in MB/s """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f(data)
+        best = min(best, time.perf_counter() - start)
+    return len(data) / best / 1e6
+
+
+def bench_match(size=1000000):
+    pattern = "(a|b|c)*abc(a|b|c)*"
+    rng = random.Random(0)
+    text = "".join(rng.choice("abc") for _ in range(size)) + "abc"
+
+    dfsa = regex.compile(pattern)
+    compiled = dfsa.compile()
+    fsm = regex.parse(pattern)
+
+    print("match {!r} on {} chars".format(pattern, len(text)))
+    print("  FSM.match:                {:6.2f} MB/s".format(
+        throughput(fsm.match, text[:size // 10])))
+    print("  DFSA.match:               {:6.2f} MB/s".format(
+        throughput(dfsa.match, text)))
+    print("  CompiledDFA.match (str):  {:6.2f} MB/s".format(
+        throughput(compiled.match, text)))
+    print("  CompiledDFA.match (bytes):{:6.2f} MB/s".format(
+        throughput(compiled.match, text.encode())))
+
+
+def bench_build(sizes=(50, 100, 200, 400, 800)):
+    rng = random.Random(0)
+    print("DFSA construction")
+    for size in sizes:
+        pattern = "(a|b)*" + "".join(rng.choice("ab") for _ in range(size))
+        fsm = regex.parse(pattern)
+        nstates = len(fsm.states)
+
+        start = time.perf_counter()
+        dfsa = regex.DFSA(fsm)
+        elapsed = time.perf_counter() - start
+        print("  {:4} NFA states -> {:4} DFA states: {:.3f}s".format(
+            nstates, len(dfsa.states), elapsed))
+
+
+def bench_lazy(size=200000):
+    rng = random.Random(0)
+    text = "".join(rng.choice("ab") for _ in range(size))
+    print("LazyDFA on {} chars".format(size))
+    for k in (4, 8, 12, 16):
+        # the full DFA has 2 ** (k + 1) states
+        pattern = "(a|b)*a" + "(a|b)" * k
+        text_k = text[:-k - 1] + "a" + text[-k:]
+        for max_states in (64, 100000):
+            lazy = regex.compile(pattern, lazy=True, max_states=max_states)
+            speed = throughput(lazy.match, text_k, repeat=1)
+            print("  k={:2} max_states={:6}: {:5.2f} MB/s, {:5} states "
+                  "cached".format(k, max_states, speed, len(lazy.sets)))
+
+
+def bench_minimize():
+    patterns = ["(a|b)*abb", "(a|b)*(a|b)*(a|b)*c", "(a|b)*a(a|b)(a|b)(a|b)",
+                "(a|b)*" + "ab" * 50]
+    print("DFSA.minimize")
+    for pattern in patterns:
+        dfsa = regex.compile(pattern, minimize=True)
+        table = dfsa.compile().table
+        print("  {:30.30} {:4} -> {:4} states, {:6} byte table".format(
+            pattern, dfsa.stats["states"], dfsa.stats["minimized"],
+            len(table) * table.itemsize))
+
+
+def bench_set(counts=(10, 50, 100, 200), nlines=1000):
+    rng = random.Random(0)
+    letters = "abcdefgh"
+
+    def word(n):
+        return "".join(rng.choice(letters) for _ in range(n))
+
+    patterns = [word(3) + "(a|b)*" + word(2) for _ in range(max(counts))]
+    lines = [word(3) + "ab" * rng.randint(0, 20) + word(2)
+             for _ in range(nlines)]
+    print("compile_set on {} lines".format(nlines))
+    for count in counts:
+        start = time.perf_counter()
+        compiled = regex.compile_set(patterns[:count]).compile()
+        built = time.perf_counter() - start
+        start = time.perf_counter()
+        for line in lines:
+            compiled.matches(line)
+        together = time.perf_counter() - start
+
+        singles = [regex.compile(p).compile() for p in patterns[:count]]
+        start = time.perf_counter()
+        for line in lines:
+            [single.match(line) for single in singles]
+        separately = time.perf_counter() - start
+        print("  {:3} patterns: build {:.2f}s, match {:.3f}s "
+              "(vs {:.3f}s one at a time)".format(
+                  count, built, together, separately))
+
+
+def bench_scan(size=4000000):
+    rng = random.Random(0)
+    words = ["GET", "POST", "error", "warning", "info", "200", "404", "500"]
+    compiled = regex.compile("(e|w)rr*(o|i)r*").compile()
+
+    with tempfile.TemporaryFile() as f:
+        written = 0
+        while written < size:
+            line = " ".join(rng.choice(words) for _ in range(8)) + "\n"
+            written += f.write(line.encode())
+        f.flush()
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        start = time.perf_counter()
+        count = sum(1 for _ in compiled.finditer(data))
+        elapsed = time.perf_counter() - start
+        print("finditer over a {:.0f} MB mmap: {} matches, {:.2f} MB/s".format(
+            len(data) / 1e6, count, len(data) / elapsed / 1e6))
+        data.close()
+
+
+def bench_long_pattern(size=10000):
+    rng = random.Random(0)
+    pieces = []
+    while sum(map(len, pieces)) < size:
+        pieces.append(rng.choice(["a", "b", "(a|b)", "c*", "(ab|ba)*"]))
+    pattern = "".join(pieces)
+    # a string that matches it
+    text = "".join(rng.choice("ab") if p == "(a|b)" else
+                   "ab" if p == "(ab|ba)*" else p.rstrip("*")
+                   for p in pieces)
+
+    start = time.perf_counter()
+    fsm = regex.parse(pattern)
+    parsed = time.perf_counter() - start
+    start = time.perf_counter()
+    fsm.match(text)
+    matched = time.perf_counter() - start
+    print("{} char pattern: parse {:.2f}s ({} NFA states), "
+          "FSM.match {:.2f} MB/s".format(len(pattern), parsed,
+                                         len(fsm.states),
+                                         len(text) / matched / 1e6))
+
+    # one big alternation of words, on its own and repeated
+    words = []
+    while sum(map(len, words)) + len(words) < size:
+        words.append("".join(rng.choice("abcdefgh")
+                             for _ in range(rng.randint(3, 8))))
+    alternation = "|".join(words)
+    for name, pattern in [("alternation", alternation),
+                          ("starred alternation", "(" + alternation + ")*")]:
+        start = time.perf_counter()
+        fsm = regex.parse(pattern)
+        parsed = time.perf_counter() - start
+        print("{} char {} of {} words: parse {:.2f}s ({} NFA states)".format(
+            len(pattern), name, len(words), parsed, len(fsm.states)))
+
+
+def bench_load():
+    rng = random.Random(0)
+    pattern = "(a|b)*" + "".join(rng.choice("ab") for _ in range(2000))
+    start = time.perf_counter()
+    compiled = regex.DFSA(regex.parse(pattern)).compile()
+    built = time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "pattern.rxdf")
+        compiled.save(path)
+        start = time.perf_counter()
+        regex.CompiledDFA.load(path)
+        loaded = time.perf_counter() - start
+        print("{} state DFA: compile {:.3f}s, load {:.4f}s ({} bytes)".format(
+            compiled.nstates, built, loaded, os.path.getsize(path)))
+
+
+def bench_classes(size=500000):
+    pattern = "[A-Za-z0-9._-]+@[a-zé]+(\\.[a-z]+)+"
+    dfsa = regex.compile(pattern)
+    compiled = dfsa.compile()
+    print("{}: {} intervals -> {} classes, {} states".format(
+        pattern, len(dfsa.alphabet), compiled.nclasses, compiled.nstates))
+
+    rng = random.Random(0)
+    ascii_text = "".join(rng.choice("abc.xyz09") for _ in range(size))
+    text = ascii_text[:-3] + "@café.com"
+    for name, data in [("latin-1", text), ("unicode", text + "\u20ac"),
+                       ("bytes", text.encode("latin-1"))]:
+        print("  search ({:7}): {:.2f} MB/s".format(
+            name, throughput(compiled.search, data, repeat=1)))
+
+
+def bench_parallel(size=2 << 30, chunksize=1 << 26):
+    """ Scaling of parallel_match over a synthetic file of size bytes """
+    compiled = regex.compile("[a-z \n]*(end)?").compile()
+    rng = random.Random(0)
+    block = "".join(rng.choice("abcdefgh \n") for _ in range(1 << 20))
+    block = block.encode()
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "input")
+        with open(path, "wb") as f:
+            for _ in range(size // len(block)):
+                f.write(block)
+            f.write(block[:size % len(block)])
+        processes = 1
+        while processes <= os.cpu_count():
+            start = time.perf_counter()
+            compiled.parallel_match(path, processes, chunksize)
+            elapsed = time.perf_counter() - start
+            print("parallel {} processes: {:.1f} MB/s".format(
+                processes, size / elapsed / 1e6))
+            processes *= 2
+
+
+if __name__ == "__main__":
+    bench_match()
+    bench_build()
+    bench_lazy()
+    bench_minimize()
+    bench_set()
+    bench_scan()
+    bench_long_pattern()
+    bench_load()
+    bench_classes()
+    bench_parallel()
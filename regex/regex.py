@@ -1,5 +1,13 @@
+from array import array
+from bisect import bisect_right
 from collections import deque
-from functools import reduce
+from functools import lru_cache, reduce
+import mmap
+import multiprocessing
+import os
+import struct
+import sys
+import tempfile
 
 
 class State(dict):
@@ -27,14 +35,15 @@ class State(dict):
 class DFSA():
 
     def __init__(self, fsm):
-        fsm.remove()
-        fsm.clean()
+        fsm.label()
+        self.alphabet = fsm.alphabet
+        self.anchor_start, self.anchor_end = fsm.anchor_start, fsm.anchor_end
+        self._build(fsm.descend({fsm.begin}))
 
-        self.nstates = list(fsm.states)
-        self.size = 2 ** len(self.nstates)
+    def _build(self, states):
+        """ Subset construction, starting from a set of NFA states """
+        self.ids = {}
         self.states, self.done = {}, {}
-        
-        states = fsm.descend({fsm.begin})
         self.begin = self.toIndex(states)
 
         stack = deque([states])
@@ -44,30 +53,559 @@ class DFSA():
             states = stack.pop()
             index = self.toIndex(states)
             if index not in visited:
-                self.done[index] = any(state.done for state in states)
+                self.done[index] = self._accepting(states)
                 visited.add(index)
                 self.states[index] = {}
                 for key in self._getKeys(states):
-                    new = reduce(set.union, (s[key] for s in states), set())
+                    new = step(states, key)
                     stack.append(new)
                     if new:
                         self.states[index][key] = self.toIndex(new)
+        self.stats = {"states": len(self.states)}
+    def _accepting(self, states):
+        return any(state.done for state in states)
     def match(self, s):
+        classify = self.alphabet.classify
         try:
             state = self.begin
             for char in s:
-                state = self.states[state][char]
-            return True
+                state = self.states[state][classify(char)]
+            return self.done[state]
         except KeyError:
             return False
+    def compile(self):
+        return CompiledDFA(self)
+
+    def minimize(self):
+        """ Merge equivalent states (Hopcroft's algorithm), in place """
+        dead = -1
+        alphabet = self._getKeys(self.states.values())
+        # inverse[char][target] = states with a `char` transition to target,
+        # where missing transitions go to an explicit dead state
+        inverse = {char: {} for char in alphabet}
+        for index, transitions in self.states.items():
+            for char in alphabet:
+                target = transitions.get(char, dead)
+                inverse[char].setdefault(target, set()).add(index)
+        for char in alphabet:
+            inverse[char].setdefault(dead, set()).add(dead)
+
+        # start from states grouped by what they accept (just True/False,
+        # except for a PatternSet)
+        groups = {None: {dead}}
+        for index in self.states:
+            groups.setdefault(self.done[index] or None, set()).add(index)
+        blocks = list(groups.values())
+        blockOf = {q: b for b, block in enumerate(blocks) for q in block}
+
+        work = set(range(len(blocks)))
+        while work:
+            splitter = frozenset(blocks[work.pop()])
+            for char in alphabet:
+                sources = set()
+                for target in splitter:
+                    sources.update(inverse[char].get(target, ()))
+
+                touched = {}
+                for q in sources:
+                    touched.setdefault(blockOf[q], set()).add(q)
+                for b, inside in touched.items():
+                    if len(inside) == len(blocks[b]):
+                        continue
+                    blocks[b] -= inside
+                    new = len(blocks)
+                    blocks.append(inside)
+                    for q in inside:
+                        blockOf[q] = new
+                    if b in work or len(inside) <= len(blocks[b]):
+                        work.add(new)
+                    else:
+                        work.add(b)
+
+        # renumber the blocks densely, dropping the states that can never
+        # reach an accepting state (unless that's where we begin)
+        deadBlock = blockOf[dead]
+        numbers = {blockOf[self.begin]: 0}
+        for index in sorted(self.states):
+            if blockOf[index] != deadBlock:
+                numbers.setdefault(blockOf[index], len(numbers))
+
+        states, done = {}, {}
+        for index, transitions in self.states.items():
+            number = numbers.get(blockOf[index])
+            if number is None or number in states:
+                continue
+            states[number] = {char: numbers[blockOf[target]]
+                              for char, target in transitions.items()
+                              if blockOf[target] != deadBlock}
+            done[number] = self.done[index]
+
+        self.ids = {key: numbers[blockOf[index]]
+                    for key, index in self.ids.items()
+                    if blockOf[index] in numbers}
+        self.begin = 0
+        self.states, self.done = states, done
+        self.stats["minimized"] = len(states)
+        return self
 
     def toIndex(self, states):
-        bits = [i for i, s in enumerate(self.nstates) if s in states]
-        bitstring = "".join("1" if bit in bits else "0"
-                            for bit in range(self.size))
-        return int(bitstring, 2)
+        """ Number each distinct set of NFA states, in order of discovery """
+        key = frozenset(states)
+        if key not in self.ids:
+            self.ids[key] = len(self.ids)
+        return self.ids[key]
     def _getKeys(self, states):
-        return reduce(set.union, (set(s) for s in states), set())
+        keys = reduce(set.union, (set(s) for s in states), set())
+        keys.discard(None)
+        return keys
+
+
+class PatternSet(DFSA):
+    """ Many patterns determinized together.
+
+    The patterns' NFAs are joined with Branch and each DFA state is tagged
+    with the (indices of the) patterns that accept there, so one pass over
+    the input finds every pattern that matches. Anchors only matter when
+    searching, which doesn't tell the patterns apart, so they're ignored.
+    With no patterns at all, nothing matches.
+    """
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        fsms = [thompson(pattern) for pattern in self.patterns]
+        self.alphabet = Alphabet(set().union(*(f.ranges() for f in fsms)))
+        for fsm in fsms:
+            fsm.relabel(self.alphabet)
+        self.anchor_start = self.anchor_end = False
+        self.tags = {state: i for i, fsm in enumerate(fsms)
+                     for state in fsm.states if state.done}
+        fsm = Branch(*fsms)
+        self._build(fsm.descend({fsm.begin}))
+
+    def _accepting(self, states):
+        return frozenset(self.tags[s] for s in states if s in self.tags)
+
+    def match(self, s):
+        """ The indices of the patterns that match s """
+        return DFSA.match(self, s) or frozenset()
+
+
+class CompiledDFA():
+    """ A DFSA flattened into a dense transition table.
+
+    States are renumbered 1...n (0 is a dead state that loops to itself).
+    The intervals of the DFSA's alphabet that every state treats the same
+    are merged into one class (0 is every character without a transition),
+    so that `table[state * nclasses + cls]` is the next state.
+    """
+    def __init__(self, dfsa):
+        ids = {dfsa.begin: 1}
+        for index in dfsa.states:
+            ids.setdefault(index, len(ids) + 1)
+        rows = [dfsa.states[index] for index in ids]
+        self.nstates = len(ids) + 1
+        self.begin = 1
+        self.anchor_start, self.anchor_end = dfsa.anchor_start, dfsa.anchor_end
+
+        columns = {(0,) * len(rows): 0}
+        intervalClasses = []
+        for atom in range(len(dfsa.alphabet)):
+            column = tuple(ids[row[atom]] if atom in row else 0
+                           for row in rows)
+            intervalClasses.append(columns.setdefault(column, len(columns)))
+        self.nclasses = len(columns)
+
+        # class `interval_classes[i]` covers code points
+        # starts[i]...starts[i + 1] - 1
+        self.starts, self.interval_classes = [], []
+        for start, cls in zip(dfsa.alphabet.starts, intervalClasses):
+            if not self.interval_classes or self.interval_classes[-1] != cls:
+                self.starts.append(start)
+                self.interval_classes.append(cls)
+
+        self.table = array("i", [0]) * (self.nstates * self.nclasses)
+        for column, cls in columns.items():
+            for state, target in enumerate(column, 1):
+                self.table[state * self.nclasses + cls] = target
+        self.accept = bytearray(self.nstates)
+        self.done = [dfsa._accepting(())] * self.nstates
+        for index, state in ids.items():
+            self.accept[state] = bool(dfsa.done[index])
+            self.done[state] = dfsa.done[index]
+
+        self._byteClasses()
+
+    def classify(self, char):
+        return self.interval_classes[bisect_right(self.starts, ord(char)) - 1]
+
+    def _byteClasses(self):
+        # bytes (and latin-1 strings) can be mapped to classes in one go
+        # with bytes.translate
+        if self.nclasses <= 256:
+            self.byte_classes = bytes(self.classify(chr(b))
+                                      for b in range(256))
+        else:
+            self.byte_classes = None
+
+    # magic, version, flags, nstates, nclasses, begin, nintervals, ntags
+    _header = struct.Struct("<4sHHIIIII4x")
+    _BIG_ENDIAN, _TAGGED, _ANCHOR_START, _ANCHOR_END = 1, 2, 4, 8
+
+    def save(self, path):
+        """ Write the table to a file that `CompiledDFA.load` can map back
+        into memory.
+
+        The layout is the header, then the transition table (native int32),
+        the (interval start, class) pairs, one accept byte per state and,
+        for a PatternSet, each state's tag count followed by its tags.
+        """
+        tagged = any(not isinstance(done, bool) for done in self.done)
+        flags = ((self._BIG_ENDIAN if sys.byteorder == "big" else 0) |
+                 (self._TAGGED if tagged else 0) |
+                 (self._ANCHOR_START if self.anchor_start else 0) |
+                 (self._ANCHOR_END if self.anchor_end else 0))
+        classes = array("I")
+        for start, cls in zip(self.starts, self.interval_classes):
+            classes.extend((start, cls))
+        tags = array("I")
+        if tagged:
+            for done in self.done:
+                tags.append(len(done))
+                tags.extend(sorted(done))
+
+        with open(path, "wb") as f:
+            f.write(self._header.pack(b"RXDF", 2, flags, self.nstates,
+                                      self.nclasses, self.begin,
+                                      len(self.starts), len(tags)))
+            f.write(array("i", self.table).tobytes())
+            f.write(classes.tobytes())
+            f.write(bytes(self.accept))
+            f.write(tags.tobytes())
+
+    @staticmethod
+    def load(path):
+        """ Map a table written by `save` into memory. The transition table
+        is used in place, without copying. """
+        with open(path, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, flags, nstates, nclasses, begin,
+         nintervals, ntags) = CompiledDFA._header.unpack_from(data)
+        if magic != b"RXDF" or version != 2:
+            raise ValueError("{} is not a compiled regex".format(path))
+        if bool(flags & CompiledDFA._BIG_ENDIAN) != (sys.byteorder == "big"):
+            raise ValueError("{} has the wrong byte order".format(path))
+
+        dfa = CompiledDFA.__new__(CompiledDFA)
+        dfa.nstates, dfa.nclasses, dfa.begin = nstates, nclasses, begin
+        dfa.anchor_start = bool(flags & CompiledDFA._ANCHOR_START)
+        dfa.anchor_end = bool(flags & CompiledDFA._ANCHOR_END)
+        view = memoryview(data)
+        offset = CompiledDFA._header.size
+        size = 4 * nstates * nclasses
+        dfa.table = view[offset:offset + size].cast("i")
+        offset += size
+
+        pairs = view[offset:offset + 8 * nintervals].cast("I")
+        dfa.starts = list(pairs[0::2])
+        dfa.interval_classes = list(pairs[1::2])
+        offset += 8 * nintervals
+
+        dfa.accept = view[offset:offset + nstates]
+        offset += nstates
+        if flags & CompiledDFA._TAGGED:
+            tags = view[offset:offset + 4 * ntags].cast("I")
+            dfa.done, i = [], 0
+            for _ in range(nstates):
+                dfa.done.append(frozenset(tags[i + 1:i + 1 + tags[i]]))
+                i += 1 + tags[i]
+        else:
+            dfa.done = [bool(accept) for accept in dfa.accept]
+
+        dfa._byteClasses()
+        return dfa
+
+    def _classes(self, s):
+        """ The character classes of s, as an iterable of ints """
+        if isinstance(s, str):
+            try:
+                s = s.encode("latin-1")
+            except UnicodeEncodeError:
+                return (self.classify(char) for char in s)
+        else:
+            s = bytes(s)
+        if self.byte_classes is None:
+            return (self.classify(chr(b)) for b in s)
+        return s.translate(self.byte_classes)
+
+    def run(self, s):
+        """ The state s ends in (0 if it falls off the DFA) """
+        table, nclasses = self.table, self.nclasses
+        state = self.begin
+        for cls in self._classes(s):
+            state = table[state * nclasses + cls]
+            if not state:
+                return 0
+        return state
+
+    def match(self, s):
+        return bool(self.accept[self.run(s)])
+
+    def matches(self, s):
+        """ What the DFSA's state for s accepts: a bool, or for a PatternSet
+        the indices of the patterns that match """
+        return self.done[self.run(s)]
+
+    def transitions(self, data):
+        """ The state each state ends in after reading data, as a list
+        indexed by state (0 for those that die) """
+        table, nclasses = self.table, self.nclasses
+        # runs from different states merge once they reach the same state,
+        # so track which start states each current state stands for
+        groups = {state: [state] for state in range(1, self.nstates)}
+        classes = iter(self._classes(data))
+        for cls in classes:
+            new = {}
+            for state, starts in groups.items():
+                target = table[state * nclasses + cls]
+                if target in new:
+                    new[target].extend(starts)
+                elif target:
+                    new[target] = starts
+            groups = new
+            if len(groups) <= 1:
+                break
+
+        if len(groups) == 1:
+            [(state, starts)] = groups.items()
+            for cls in classes:
+                state = table[state * nclasses + cls]
+                if not state:
+                    break
+            groups = {state: starts}
+
+        ends = [0] * self.nstates
+        for state, starts in groups.items():
+            for start in starts:
+                ends[start] = state
+        return ends
+
+    def parallel_match(self, path, processes=None, chunksize=1 << 26):
+        """ Whether the whole of the file at path matches (byte by byte, as
+        latin-1), splitting it into chunks that a process pool runs from
+        every state at once. Chaining the chunks' state mappings from the
+        begin state then gives the final state. """
+        size = os.path.getsize(path)
+        chunks = [(path, start, min(start + chunksize, size))
+                  for start in range(0, size, chunksize)]
+        with tempfile.TemporaryDirectory() as tmp:
+            table = os.path.join(tmp, "table")
+            self.save(table)
+            with multiprocessing.Pool(processes, _initWorker,
+                                      (table,)) as pool:
+                mappings = pool.imap(_workerTransitions, chunks)
+                state = self.begin
+                for ends in mappings:
+                    state = ends[state]
+        return bool(self.accept[state])
+
+    def scanner(self):
+        return Scanner(self)
+
+    def finditer(self, data, start=0, chunksize=1 << 16):
+        """ Yield the (start, end) of each non-overlapping, leftmost-longest
+        match in data (a str, bytes, memoryview, mmap, ...), reading it
+        `chunksize` characters at a time """
+        scanner = Scanner(self, start)
+        for i in range(start, len(data), chunksize):
+            yield from scanner.feed(data[i:i + chunksize])
+        yield from scanner.close()
+
+    def search(self, data, start=0, chunksize=1 << 16):
+        """ The (start, end) of the leftmost-longest match in data, or None
+        """
+        for match in self.finditer(data, start, chunksize):
+            return match
+        return None
+
+
+# The CompiledDFA each `parallel_match` worker process runs
+_workerDFA = None
+
+def _initWorker(path):
+    global _workerDFA
+    _workerDFA = CompiledDFA.load(path)
+
+def _workerTransitions(chunk):
+    path, start, stop = chunk
+    with open(path, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        return array("i", _workerDFA.transitions(data[start:stop]))
+    finally:
+        data.close()
+
+
+class Scanner():
+    """ Finds leftmost-longest matches of a CompiledDFA in a stream, in one
+    forward pass.
+
+    A run of the DFA starts at every position, but runs that reach the same
+    DFA state are merged, keeping the earliest start (from there on they
+    match the same strings), so at most one run per DFA state is alive.
+    Once a run accepts, runs that started later can't be leftmost and are
+    dropped; the match is reported once no run that could move it left or
+    make it longer is alive, and the search resumes from its end.
+
+    So the input is only kept from the end of the current candidate match
+    (to resume from), and a stream without matches takes constant memory.
+
+    With a ^ anchor only the first position is tried, and with a $ anchor
+    runs only match if they last until the end of the input.
+    """
+    def __init__(self, dfa, offset=0):
+        self.dfa = dfa
+        self.origin = offset
+        self.offset = offset        # stream position of buffer[0]
+        self.position = offset      # stream position of the next character
+        self.resume = offset        # where the next match may start
+        self.wide = dfa.byte_classes is None
+        self.buffer = array("i") if self.wide else b""
+        # the start of the run in each DFA state, earliest first
+        self.runs = {}
+        # the (start, end) of the best match found so far
+        self.candidate = None
+
+    def feed(self, chunk):
+        """ Scan the next chunk, returning the matches that are now known """
+        classes = self.dfa._classes(chunk)
+        if self.wide:
+            classes = array("i", classes)
+        elif not isinstance(classes, bytes):
+            classes = bytes(classes)
+        self.buffer += classes
+        return list(self._scan(final=False))
+
+    def close(self):
+        """ Signal the end of the input, returning the remaining matches """
+        return list(self._scan(final=True))
+
+    def _scan(self, final):
+        table, nclasses = self.dfa.table, self.dfa.nclasses
+        accept, begin = self.dfa.accept, self.dfa.begin
+        anchorStart, anchorEnd = self.dfa.anchor_start, self.dfa.anchor_end
+        buffer, offset = self.buffer, self.offset
+        end = offset + len(buffer)
+        runs, candidate = self.runs, self.candidate
+        position, resume = self.position, self.resume
+
+        while position <= end:
+            if candidate is None and not runs and position >= resume:
+                if anchorStart and position > self.origin:
+                    # nothing can match any more
+                    position = end
+                    if final:
+                        break
+                elif not accept[begin]:
+                    # skip the positions where a run would die at once
+                    row = begin * nclasses
+                    while (position < end and
+                           not table[row + buffer[position - offset]]):
+                        position += 1
+
+            if (candidate is None and position >= resume and
+                    begin not in runs and
+                    (not anchorStart or position == self.origin)):
+                runs[begin] = position
+
+            if not anchorEnd or (final and position == end):
+                for state, start in runs.items():
+                    if accept[state]:
+                        if candidate is None or start <= candidate[0]:
+                            candidate = (start, position)
+                        break
+                if candidate is not None and len(runs) > 1:
+                    runs = {state: start for state, start in runs.items()
+                            if start <= candidate[0]}
+
+            if position < end:
+                cls = buffer[position - offset]
+                new = {}
+                for state, start in runs.items():
+                    target = table[state * nclasses + cls]
+                    if target and target not in new:
+                        new[target] = start
+                runs = new
+                position += 1
+            elif final:
+                runs = {}
+            else:
+                break
+
+            if candidate is not None and not runs:
+                yield candidate
+                start, stop = candidate
+                candidate = None
+                # look for the next match from the end of this one
+                position = resume = stop if stop > start else start + 1
+            elif final and position == end and not runs:
+                break
+
+        keep = candidate[1] if candidate is not None else min(position, end)
+        self.buffer = buffer[keep - offset:]
+        self.offset = keep
+        self.runs, self.candidate = runs, candidate
+        self.position, self.resume = position, resume
+
+
+class LazyDFA():
+    """ A DFA that is only determinized as the input reaches new states.
+
+    At most `max_states` DFA states are kept. Once the cache is full,
+    matching continues by simulating the NFA (like FSM.match) from the
+    current set of NFA states, so memory stays bounded for patterns whose
+    full DFA would be exponentially large.
+    """
+    def __init__(self, fsm, max_states=10000):
+        fsm.label()
+
+        self.fsm = fsm
+        self.max_states = max_states
+        self.ids = {}
+        self.sets, self.states, self.done = [], [], []
+        self.begin = self._toIndex(fsm.descend({fsm.begin}))
+
+    def _toIndex(self, states):
+        """ The DFA state for a set of NFA states, or None if it's new and
+        the cache is full """
+        key = frozenset(states)
+        if key not in self.ids:
+            if len(self.sets) >= self.max_states:
+                return None
+            self.ids[key] = len(self.sets)
+            self.sets.append(key)
+            self.states.append({})
+            self.done.append(any(state.done for state in key))
+        return self.ids[key]
+
+    def match(self, s):
+        classify = self.fsm.alphabet.classify
+        state = self.begin
+        for i, char in enumerate(s):
+            transitions = self.states[state]
+            key = classify(char)
+            if key in transitions:
+                state = transitions[key]
+            else:
+                new = step(self.sets[state], key)
+                if not new:
+                    transitions[key] = None
+                    return False
+                index = self._toIndex(new)
+                if index is None:
+                    return self.fsm.match(s[i + 1:], new)
+                state = transitions[key] = index
+            if state is None:
+                return False
+        return self.done[state]
 
 
 class FSM():
@@ -75,60 +613,190 @@ class FSM():
         self.begin = State()
         self.done = State()
         self.states = {self.begin, self.done}
+        self.alphabet = None
+        self.anchor_start = self.anchor_end = False
     def new(self):
         new = State()
         self.states.add(new)
         return new
-    def match(self, s):
-        states = {self.begin}
+    def match(self, s, states=None):
+        self.label()
+        classify = self.alphabet.classify
+        if states is None:
+            states = {self.begin}
         for char in s:
-            states = reduce(set.union, (state[char] for state in states), 
-                            set())
+            states = step(states, classify(char))
             if not states:
                 break
         return any(state.done for state in states)
+    def label(self):
+        """ Make an FSM built straight from Basic, Concat, Branch and so on
+        ready to match, as parse() does: remove its empty transitions and key
+        them by an Alphabet of its own """
+        if self.alphabet is None:
+            self.remove()
+            self.clean()
+            self.relabel(Alphabet(self.ranges()))
     def remove(self):
-        """ Remove empty transitions """
+        """ Remove empty transitions.
+
+        Each state takes the moves of everything it reaches by empty
+        transitions. These are worked out once per strongly connected
+        component of the empty transitions, after the components it leads
+        to, and a component that just passes through to one other shares
+        that one's moves rather than copying them.
+        """
+        componentOf, moves, done = {}, [], []
+        for members in self._emptyComponents():
+            c = len(moves)
+            for state in members:
+                componentOf[state] = c
+            successors = {componentOf[other] for state in members
+                          for other in state.get(None, ())} - {c}
+            own = [state for state in members
+                   if any(key is not None for key in state)]
+            accepting = (self.done in members or
+                         any(state.done for state in members) or
+                         any(done[other] for other in successors))
+
+            if not own and len(successors) == 1:
+                moves.append(moves[successors.pop()])
+                done.append(accepting)
+                continue
+
+            # target sets are shared, never updated in place
+            parts = {}
+            for state in own:
+                for key, targets in state.items():
+                    if key is not None:
+                        parts.setdefault(key, []).append(targets)
+            for other in successors:
+                for key, targets in moves[other].items():
+                    parts.setdefault(key, []).append(targets)
+            moves.append({key: targets[0] if len(targets) == 1
+                          else set().union(*targets)
+                          for key, targets in parts.items()})
+            done.append(accepting)
+
         for state in self.states:
-            for key in frozenset(state):
-                if key is None:
-                    toVisit = self.descend(state[key])
-                    for other in frozenset(toVisit):
-                        for k, value in other.items():
-                            state[k].update(value)
-                    if self.done in toVisit:
-                        state.done = True
-                    del state[None]
-                else:
-                    new = self._descendOneLevel(state[key])
-                    while any(x not in state[key] for x in new):
-                        new = self._descendOneLevel(state[key])
-                        del state[key]
-                        state[key] = new
+            state.clear()
+            state.update(moves[componentOf[state]])
+            state.done = done[componentOf[state]]
         self.done.done = True
+    def _emptyComponents(self):
+        """ The strongly connected components of the empty transitions, each
+        after every component it leads to (Tarjan's algorithm, without
+        recursion) """
+        index, low = {}, {}
+        stack, onStack, components = [], set(), []
+        for root in self.states:
+            if root in index:
+                continue
+            index[root] = low[root] = len(index)
+            stack.append(root)
+            onStack.add(root)
+            work = [(root, iter(root.get(None, ())))]
+            while work:
+                state, children = work[-1]
+                for child in children:
+                    if child not in index:
+                        index[child] = low[child] = len(index)
+                        stack.append(child)
+                        onStack.add(child)
+                        work.append((child, iter(child.get(None, ()))))
+                        break
+                    elif child in onStack:
+                        low[state] = min(low[state], index[child])
+                else:
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        low[parent] = min(low[parent], low[state])
+                    if low[state] == index[state]:
+                        members = []
+                        while True:
+                            member = stack.pop()
+                            onStack.discard(member)
+                            members.append(member)
+                            if member is state:
+                                break
+                        components.append(members)
+        return components
     def clean(self):
         """ Remove unused states """
         visited = set()
+        # after remove(), many states share the same target sets, so only
+        # walk each one once
+        seen = set()
         toVisit = deque([self.begin])
         while toVisit:
             state = toVisit.pop()
             if state not in visited:
-                toVisit.extend(v for value in state.values() 
-                                 for v in value)
+                for value in state.values():
+                    if id(value) not in seen:
+                        seen.add(id(value))
+                        toVisit.extend(value)
             visited.add(state)
         for state in frozenset(self.states):
             if state not in visited:
                 self.states.remove(state)
                 del state
-    def _descendOneLevel(self, states):
-        return reduce(set.union, (state[None] for state in states), set())
-
     def descend(self, states):
-        none = self._descendOneLevel(states)
-        while any(x not in states for x in none) and none:
-            states |= none
-            none = self._descendOneLevel(states)
+        """ Add everything reachable by empty transitions to states """
+        stack = list(states)
+        while stack:
+            for other in stack.pop().get(None, ()):
+                if other not in states:
+                    states.add(other)
+                    stack.append(other)
         return states
+    def ranges(self):
+        """ The (lo, hi) code point ranges of all transitions """
+        return {key for state in self.states for key in state
+                if key is not None}
+    def relabel(self, alphabet):
+        """ Key transitions by the alphabet's intervals, instead of ranges """
+        for state in self.states:
+            parts = {}
+            for key, targets in state.items():
+                if key is not None:
+                    for interval in alphabet.intervals(*key):
+                        parts.setdefault(interval, []).append(targets)
+            state.clear()
+            # like remove(), share target sets rather than copying them
+            state.update((interval, targets[0] if len(targets) == 1
+                          else set().union(*targets))
+                         for interval, targets in parts.items())
+        self.alphabet = alphabet
+
+
+class Alphabet():
+    """ Splits the code points into intervals that no transition tells
+    apart, so that transitions can be keyed by interval number """
+    def __init__(self, ranges):
+        starts = {0}
+        for lo, hi in ranges:
+            starts.add(lo)
+            starts.add(hi + 1)
+        self.starts = sorted(starts)
+    def __len__(self):
+        return len(self.starts)
+    def classify(self, char):
+        return bisect_right(self.starts, ord(char)) - 1
+    def intervals(self, lo, hi):
+        """ The intervals making up lo...hi """
+        return range(bisect_right(self.starts, lo) - 1,
+                     bisect_right(self.starts, hi))
+
+
+def step(states, char):
+    """ The NFA states reachable from any of states on char """
+    new = set()
+    for state in states:
+        targets = state.get(char)
+        if targets:
+            new |= targets
+    return new
 
 
 def Concat(r1, r2):
@@ -136,26 +804,50 @@ def Concat(r1, r2):
     r1.states |= r2.states
     r1.done = r2.done
     return r1
-def Branch(r1, r2):
+def Branch(*fsms):
+    """ Any one of fsms. Taking them all at once, rather than nesting pairs,
+    keeps the empty transitions between them from piling up. """
+    f = FSM()
+    for r in fsms:
+        f.begin[None].add(r.begin)
+        r.done[None].add(f.done)
+        f.states |= r.states
+    return f
+
+def Repeat(r1):
     f = FSM()
     f.begin[None].add(r1.begin)
-    f.begin[None].add(r2.begin)
+    f.begin[None].add(f.done)
+    r1.done[None].add(r1.begin)
     r1.done[None].add(f.done)
-    r2.done[None].add(f.done)
     f.states |= r1.states
-    f.states |= r2.states
     return f
 
-def Repeat(r1):
+def Plus(r1):
+    f = FSM()
+    f.begin[None].add(r1.begin)
     r1.done[None].add(r1.begin)
-    r1.begin[None].add(r1.done)
-    return r1
+    r1.done[None].add(f.done)
+    f.states |= r1.states
+    return f
 
-def Basic(r1):
+def Optional(r1):
+    return Branch(r1, Empty())
+
+def Empty():
     f = FSM()
-    f.begin[r1].add(f.done)
+    f.begin[None].add(f.done)
     return f
 
+def Ranges(ranges):
+    f = FSM()
+    for lo, hi in ranges:
+        f.begin[(lo, hi)].add(f.done)
+    return f
+
+def Basic(r1):
+    return Ranges([(ord(r1), ord(r1))])
+
 
 class Regex(object):
     """Dummy Class for pretty print testing"""
@@ -173,45 +865,158 @@ class Regex(object):
     def __repr__(self):
         return str(self)
 
-def findClose(s):
-    level = 0
-    for i, char in enumerate(s):
-        if char == ')':
-            if level == 1:
-                return i
-            else:
-                level -= 1
-        elif char == '(':
-            level += 1
-
-
-def parse(s, regexs=None):
-    fold = False
-    if regexs is None:
-        regexs = deque()
-        fold = True
-    if s:
-        if s[0] == "*":
-            regexs[-1] = Repeat(regexs[-1])
-            parse(s[1:], regexs)
-        elif s[0] == "|":
-            other = deque()
-            parse(s[1:], other)
-
-            regexs[-1] = Branch(regexs[-1], other.popleft())
-            regexs.extend(other)
-        elif s[0] == "(":
-            # skip closing paren, so add one
-            nxt, rest = s[1:findClose(s)], s[findClose(s) + 1:]
-            regexs.append(parse(nxt))
-            parse(rest, regexs)
+MAX_CODE_POINT = 0x10FFFF
+
+_ESCAPES = {
+    "d": [(48, 57)],
+    "w": [(48, 57), (65, 90), (95, 95), (97, 122)],
+    "s": [(9, 13), (32, 32)],
+    "n": [(10, 10)],
+    "t": [(9, 9)],
+}
+
+def _complement(ranges):
+    out, lo = [], 0
+    for start, end in sorted(ranges):
+        if start > lo:
+            out.append((lo, start - 1))
+        lo = max(lo, end + 1)
+    if lo <= MAX_CODE_POINT:
+        out.append((lo, MAX_CODE_POINT))
+    return out
+
+def _escape(char):
+    """ The ranges matched by \\char """
+    if char in _ESCAPES:
+        return _ESCAPES[char]
+    elif char in "DWS":
+        return _complement(_ESCAPES[char.lower()])
+    return [(ord(char), ord(char))]
+
+def _charClass(s, i):
+    """ The ranges of the [...] class whose contents begin at s[i], and the
+    index of its closing ] """
+    negate = s[i:i + 1] == "^"
+    if negate:
+        i += 1
+    first, ranges = i, []
+    while i < len(s) and (s[i] != "]" or i == first):
+        if s[i] == "\\" and i + 1 < len(s):
+            escaped = _escape(s[i + 1])
+            i += 2
+            if len(escaped) > 1 or escaped[0][0] != escaped[0][1]:
+                ranges.extend(escaped)
+                continue
+            lo = escaped[0][0]
+        else:
+            lo = ord(s[i])
+            i += 1
+
+        if s[i:i + 1] == "-" and i + 1 < len(s) and s[i + 1] != "]":
+            hi = s[i + 1]
+            i += 2
+            if hi == "\\" and i < len(s):
+                hi = s[i]
+                i += 1
+            if ord(hi) < lo:
+                raise ValueError("bad range in {!r}".format(s))
+            ranges.append((lo, ord(hi)))
+        else:
+            ranges.append((lo, lo))
+    if i >= len(s):
+        raise ValueError("unterminated character class in {!r}".format(s))
+    return (_complement(ranges) if negate else ranges), i
+
+def _alternative(pieces):
+    return reduce(Concat, pieces) if pieces else Empty()
+
+_REPEATS = {"*": Repeat, "+": Plus, "?": Optional}
+
+def thompson(s):
+    """ Thompson's construction, followed by removing empty transitions.
+
+    Transitions are keyed by (lo, hi) code point ranges. \\d, \\w and \\s
+    are ASCII-only, and ^ and $ are only allowed at the very start and end
+    of the pattern.
+    """
+    # one [alternatives, pieces] frame per open group, where pieces are the
+    # FSMs of the alternative currently being read
+    frames = [[[], []]]
+    anchorStart = anchorEnd = False
+    i = 0
+    while i < len(s):
+        char = s[i]
+        alternatives, pieces = frames[-1]
+        if char == "(":
+            frames.append([[], []])
+        elif char == ")":
+            if len(frames) == 1:
+                raise ValueError("unbalanced parenthesis in {!r}".format(s))
+            frames.pop()
+            alternatives.append(_alternative(pieces))
+            frames[-1][1].append(Branch(*alternatives))
+        elif char == "|":
+            alternatives.append(_alternative(pieces))
+            frames[-1][1] = []
+        elif char in _REPEATS:
+            if not pieces:
+                raise ValueError("nothing to repeat in {!r}".format(s))
+            pieces[-1] = _REPEATS[char](pieces[-1])
+        elif char == "[":
+            ranges, i = _charClass(s, i + 1)
+            pieces.append(Ranges(ranges))
+        elif char == ".":
+            pieces.append(Ranges(_complement(_ESCAPES["n"])))
+        elif char == "\\" and i + 1 < len(s):
+            i += 1
+            pieces.append(Ranges(_escape(s[i])))
+        elif char == "^":
+            if i != 0:
+                raise ValueError("^ must start the pattern in {!r}".format(s))
+            anchorStart = True
+        elif char == "$":
+            if i != len(s) - 1:
+                raise ValueError("$ must end the pattern in {!r}".format(s))
+            anchorEnd = True
         else:
-            regexs.append(Basic(s[0]))
-            parse(s[1:], regexs)
-        if fold:
-            f = reduce(Concat, regexs)
-            f.remove()
-            f.clean()
-            return f
-def compile(pattern):
-    return DFSA(parse(pattern))
+            pieces.append(Basic(char))
+        i += 1
+    if len(frames) != 1:
+        raise ValueError("unbalanced parenthesis in {!r}".format(s))
+
+    alternatives, pieces = frames[0]
+    alternatives.append(_alternative(pieces))
+    f = Branch(*alternatives)
+    f.remove()
+    f.clean()
+    f.anchor_start, f.anchor_end = anchorStart, anchorEnd
+    return f
+
+def parse(s):
+    """ Build an NFA for s, with transitions keyed by the intervals of its
+    own Alphabet """
+    f = thompson(s)
+    f.relabel(Alphabet(f.ranges()))
+    return f
+
+@lru_cache(maxsize=256)
+def compile(pattern, lazy=False, max_states=10000, minimize=False):
+    """ Compile pattern to a DFSA (minimized if minimize is True), or a
+    LazyDFA with at most max_states states if lazy is True.
+
+    The last 256 compiled patterns are cached, so the result is shared and
+    shouldn't be modified.
+    """
+    if lazy:
+        return LazyDFA(parse(pattern), max_states)
+    dfsa = DFSA(parse(pattern))
+    if minimize:
+        dfsa.minimize()
+    return dfsa
+
+def compile_set(patterns, minimize=False):
+    """ Compile many patterns into one PatternSet """
+    patterns = PatternSet(patterns)
+    if minimize:
+        patterns.minimize()
+    return patterns
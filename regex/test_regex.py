@@ -0,0 +1,211 @@
+import itertools
+import random
+import re
+
+import pytest
+
+import regex
+
+
+def engines(pattern):
+    """ Every way of matching pattern, as (name, match function) pairs """
+    dfsa = regex.compile(pattern)
+    return [("fsm", regex.parse(pattern).match),
+            ("dfsa", dfsa.match),
+            ("minimized", regex.compile(pattern, minimize=True).match),
+            ("lazy", regex.compile(pattern, lazy=True).match),
+            ("lazy, full cache",
+             regex.compile(pattern, lazy=True, max_states=2).match),
+            ("compiled", dfsa.compile().match)]
+
+def leftmost_longest(pattern, text):
+    """ The non-overlapping leftmost-longest matches of pattern in text,
+    found by brute force with Python's re """
+    body = pattern.lstrip("^").rstrip("$")
+    matches, i = [], 0
+    while i <= len(text):
+        if pattern.startswith("^") and i > 0:
+            break
+        stop = len(text) if pattern.endswith("$") else i
+        for j in range(len(text), stop - 1, -1):
+            if re.fullmatch(body, text[i:j], re.ASCII):
+                matches.append((i, j))
+                i = j if j > i else i + 1
+                break
+        else:
+            i += 1
+    return matches
+
+
+WORDS = ["".join(p) for n in range(4)
+         for p in itertools.product("abz9-\n", repeat=n)]
+
+def random_pattern(rng, depth=0):
+    pieces = []
+    for _ in range(rng.randint(1, 3)):
+        r = rng.random()
+        if depth > 1 or r < 0.4:
+            piece = rng.choice(["a", "b", "z", "\\d", "\\-"])
+        elif r < 0.6:
+            piece = rng.choice(["[a-c]", "[^a]", ".", "\\w", "[]a]"])
+        else:
+            piece = "({}|{})".format(random_pattern(rng, depth + 1),
+                                     random_pattern(rng, depth + 1))
+        if rng.random() < 0.3:
+            piece += rng.choice("*+?")
+        pieces.append(piece)
+    return "".join(pieces)
+
+
+# (pattern, strings that match, strings that don't)
+cases = [
+    # a DFSA used to accept any string with a matching prefix
+    ("ab", ["ab"], ["", "a", "abc", "abab"]),
+    # removing empty transitions used to drop some of a state's moves
+    ("(a|b)*c", ["c", "ac", "babc"], ["", "ab", "cc", "ca"]),
+    ("a*b*", ["", "a", "aabb", "b"], ["ba", "c"]),
+    # the end of a group used to be marked as accepting
+    ("(ab)c", ["abc"], ["ab", "a", "abcc"]),
+    ("((a|b)c)d", ["acd", "bcd"], ["ac", "bc", "a"]),
+    # | binds looser than concatenation
+    ("ab|cd", ["ab", "cd"], ["abd", "acd", "a", ""]),
+    ("a|b|cd*", ["a", "b", "c", "cdd"], ["ab", "bc", "d"]),
+    # a repeated group gets states of its own, so it can't match a prefix
+    ("(a*b)*", ["", "b", "ab", "aabab"], ["a", "aba", "ba"]),
+    ("(a*b)*c", ["c", "abc"], ["ac", "a"]),
+]
+
+@pytest.mark.parametrize("pattern,good,bad", cases)
+def test_match(pattern, good, bad):
+    for name, match in engines(pattern):
+        for s in good:
+            assert match(s), (name, s)
+        for s in bad:
+            assert not match(s), (name, s)
+
+@pytest.mark.parametrize("seed", range(4))
+def test_against_re(seed):
+    rng = random.Random(seed)
+    for _ in range(15):
+        pattern = random_pattern(rng)
+        for name, match in engines(pattern):
+            for word in WORDS:
+                expected = re.fullmatch(pattern, word, re.ASCII) is not None
+                assert match(word) == expected, (pattern, name, word)
+
+        compiled = regex.compile(pattern).compile()
+        text = "".join(rng.choice("abz9-\n") for _ in range(30))
+        expected = leftmost_longest(pattern, text)
+        for chunksize in [1, 7, 100]:
+            assert list(compiled.finditer(text, chunksize=chunksize)) == \
+                expected, (pattern, text)
+
+def test_finditer():
+    compiled = regex.compile("a+|b").compile()
+    assert list(compiled.finditer("xaab-ab")) == [
+        (1, 3), (3, 4), (5, 6), (6, 7)]
+    assert compiled.search("xxb") == (2, 3)
+    assert compiled.search("xx") is None
+
+def test_pattern_set():
+    patterns = regex.compile_set(["ab*", "b+", "a|b"])
+    compiled = patterns.compile()
+    for s, expected in [("a", {0, 2}), ("abb", {0}), ("b", {1, 2}),
+                        ("", set()), ("ba", set())]:
+        assert patterns.match(s) == expected
+        assert compiled.matches(s) == expected
+
+    empty = regex.compile_set([])
+    assert empty.match("") == frozenset()
+    assert empty.match("a") == frozenset()
+    assert not empty.compile().match("a")
+
+def test_scanner_long_stream():
+    # every position could start a match, but none ever finishes
+    compiled = regex.compile("[^x]*x").compile()
+    scanner = compiled.scanner()
+    for _ in range(100):
+        assert scanner.feed("a" * 10000) == []
+        assert len(scanner.buffer) == 0
+    # the run that matched is alive until it reads another character
+    assert scanner.feed("x") == []
+    assert scanner.close() == [(0, 1000001)]
+
+    # a match that might still grow keeps the input after it
+    compiled = regex.compile("a|ab*c").compile()
+    scanner = compiled.scanner()
+    assert scanner.feed("ab") == []
+    assert scanner.feed("bbd") == [(0, 1)]
+    assert len(scanner.buffer) == 0
+    assert scanner.feed("abcd") == [(5, 8)]
+    assert scanner.close() == []
+
+def test_long_alternation():
+    words = ["w{}x".format(i) for i in range(2000)]
+    for pattern in ["|".join(words), "(" + "|".join(words) + ")*"]:
+        dfsa = regex.compile(pattern)
+        assert dfsa.match("w1999x")
+        assert not dfsa.match("w2000x")
+    assert dfsa.match("w1xw22x")
+
+def test_helpers():
+    # FSMs built without parse() have no alphabet until they're matched
+    assert regex.Concat(regex.Basic("a"), regex.Basic("b")).match("ab")
+    fsm = regex.Repeat(regex.Branch(regex.Basic("a"),
+                                    regex.Concat(regex.Basic("b"),
+                                                 regex.Basic("c"))))
+    dfsa = regex.DFSA(fsm)
+    for s, expected in [("", True), ("abca", True), ("b", False),
+                        ("ac", False)]:
+        assert dfsa.match(s) == expected
+        assert dfsa.compile().match(s) == expected
+    lazy = regex.LazyDFA(regex.Plus(regex.Basic("a")))
+    assert lazy.match("aaa") and not lazy.match("")
+
+def test_save_load(tmp_path):
+    text = "xaab-ab\nabbb"
+    for name, compiled in [
+            ("plain", regex.compile("a+|b").compile()),
+            ("anchored", regex.compile("^a[ab]*b$").compile()),
+            ("set", regex.compile_set(["ab*", "b+", "a|b"]).compile())]:
+        path = tmp_path / name
+        compiled.save(path)
+        loaded = regex.CompiledDFA.load(path)
+        assert (loaded.anchor_start, loaded.anchor_end) == \
+            (compiled.anchor_start, compiled.anchor_end)
+        assert list(loaded.table) == list(compiled.table)
+        assert list(loaded.accept) == list(compiled.accept)
+        assert loaded.done == compiled.done
+        assert list(loaded.finditer(text)) == list(compiled.finditer(text))
+        for word in WORDS:
+            assert loaded.match(word) == compiled.match(word)
+            assert loaded.matches(word) == compiled.matches(word)
+
+    # the header starts with the magic, the version and the flags, whose
+    # lowest bit is the byte order
+    header = (tmp_path / "plain").read_bytes()
+    assert header[:6] == b"RXDF\x02\x00"
+    for offset, corrupt in [(0, b"RXDG"), (4, b"\x03\x00"),
+                            (6, bytes([header[6] ^ 1]))]:
+        bad = bytearray(header)
+        bad[offset:offset + len(corrupt)] = corrupt
+        path = tmp_path / "bad"
+        path.write_bytes(bad)
+        with pytest.raises(ValueError):
+            regex.CompiledDFA.load(path)
+
+def test_parallel_match(tmp_path):
+    # chunks of a few bytes, so that runs die, merge and carry on into
+    # the next chunk
+    compiled = regex.compile("(a|bc|ab)*(cc)?").compile()
+    rng = random.Random(0)
+    texts = ["", "a", "abc", "bcbcab", "abab" * 5 + "c", "abcb", "ca"]
+    for _ in range(8):
+        text = "".join(rng.choice(["a", "bc", "ab"])
+                       for _ in range(rng.randint(3, 10)))
+        texts.append(text + rng.choice(["", "c", "cc", "b"]))
+    for i, text in enumerate(texts):
+        path = tmp_path / str(i)
+        path.write_bytes(text.encode("latin-1"))
+        assert compiled.parallel_match(path, processes=2, chunksize=3) == \
+            compiled.match(text), text
@@ -0,0 +1,182 @@
+"""Benchmarks for scheme. Run with `python bench.py`."""
+import os
+import random
+import tempfile
+import time
+
+import scheme
+
+FIB = "(define (fib n) (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2)))))"
+
+
+def timed(f, repeat=3):
+    """Best-of-`repeat` wall time of f(), in seconds"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+class Uncached(scheme.Context):
+    """Re-analyzes a function body on every call, as a baseline"""
+
+    def body(self, name):
+        args, body = self.funcs[name]
+        return self.analyze(body, args, tail_position=True)
+
+
+def bench_fib(n=20):
+    print(f"(fib {n})")
+    engines = [
+        ("re-analyzed", Uncached, "closure"),
+        ("closure", scheme.Context, "closure"),
+        ("vm", scheme.Context, "vm"),
+    ]
+    for name, cls, engine in engines:
+        ctx = cls()
+        ctx.run(FIB, engine)
+        elapsed = timed(lambda: ctx.run(f"(fib {n})", engine))
+        print(f"  {name:12} {elapsed:.3f}s")
+
+
+def bench_memo(n=25):
+    print(f"(fib {n}) memoized")
+    for define in ["define", "define-memo"]:
+        ctx = scheme.Context()
+        ctx.run(FIB.replace("define", define, 1))
+        # Without clearing the cache, the later runs would all be hits
+        elapsed = timed(lambda: (ctx.memo.clear(), ctx.run(f"(fib {n})")))
+        print(f"  {define:12} {elapsed:.4f}s")
+    print(f"  {ctx.memo_hits} hits, {ctx.memo_misses} misses")
+
+
+def bench_profile(n=20):
+    print(f"(fib {n}) profiled")
+    for engine in ["closure", "vm"]:
+        ctx = scheme.Context()
+        ctx.run(FIB, engine)
+        off = timed(lambda: ctx.run(f"(fib {n})", engine))
+        ctx.set_profiler(scheme.Profiler())
+        on = timed(lambda: ctx.run(f"(fib {n})", engine))
+        print(f"  {engine:8} off {off:.3f}s, on {on:.3f}s")
+
+
+def bench_loop(n=10000000):
+    print(f"(loop {n})")
+    for engine in ["closure", "vm"]:
+        ctx = scheme.Context()
+        ctx.run("(define (loop n) (if (= n 0) 0 (loop (- n 1))))", engine)
+        start = time.perf_counter()
+        ctx.run(f"(loop {n})", engine)
+        elapsed = time.perf_counter() - start
+        print(f"  {engine:8} {elapsed:.2f}s, {n / elapsed / 1e6:.2f}M calls/s")
+
+
+def bench_list(n=100000):
+    source = "(quasiquote (" + " ".join(map(str, range(n))) + "))"
+    length = """
+        (define (length xs n) (if (null? xs) n (length (cdr xs) (+ n 1))))
+    """
+    print(f"length of a {n} element list")
+
+    # What each cdr used to cost, when it copied the rest of a Python list
+    xs = list(range(n))
+    start = time.perf_counter()
+    while xs:
+        xs = xs[1:]
+    print(f"  {'slicing':8} {time.perf_counter() - start:.3f}s")
+
+    for engine in ["closure", "vm"]:
+        ctx = scheme.Context()
+        ctx.run(length, engine)
+        ctx.run(f"(define xs {source})", engine)
+        elapsed = timed(lambda: ctx.run("(length xs 0)", engine))
+        print(f"  {engine:8} {elapsed:.3f}s")
+
+
+def bench_snapshot(sizes=(100, 1000, 10000)):
+    print("startup from a prelude of n defines")
+    for n in sizes:
+        prelude = "\n".join(
+            f"(define (f{i} x y) (if (< x y) (f{i} (+ x 1) y) (cadr x)))"
+            for i in range(n)
+        )
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "prelude.image")
+            ctx = scheme.Context()
+            ctx.run(prelude)
+            ctx.snapshot(path)
+
+            def run():
+                scheme.Context().run(prelude)
+
+            ran = timed(run)
+            restored = timed(lambda: scheme.Context.restore(path))
+            print(f"  n={n:5}: run {ran:.4f}s, restore {restored:.4f}s")
+
+
+def bench_pmap(n=22, count=32):
+    print(f"(fib {n}) over a {count} element list")
+    ctx = scheme.Context()
+    ctx.run(FIB)
+    ctx.run("""
+        (define (map-fib xs)
+            (if (null? xs) xs (cons (fib (car xs)) (map-fib (cdr xs)))))
+    """)
+    ctx.globals["xs"] = scheme.from_list([n] * count)
+
+    elapsed = timed(lambda: ctx.run("(map-fib xs)"), repeat=1)
+    print(f"  {'map':14} {elapsed:.2f}s")
+    processes = 1
+    while processes <= os.cpu_count():
+        ctx.processes = processes
+        elapsed = timed(lambda: ctx.run("(pmap fib xs)"), repeat=1)
+        print(f"  pmap {processes:2} procs  {elapsed:.2f}s")
+        processes *= 2
+
+
+def random_form(rng, depth):
+    if depth == 0 or rng.random() < 0.3:
+        return rng.choice(["x", "acc", "fib", "12", "quasiquote", "+"])
+    return "(" + " ".join(
+        random_form(rng, depth - 1) for _ in range(rng.randint(1, 4))
+    ) + ")"
+
+
+def bench_parse(size=20000000):
+    rng = random.Random(0)
+    forms = [random_form(rng, 12) for _ in range(1000)]
+    source = "\n".join(forms * (size // len("\n".join(forms)) + 1))
+
+    def count(forms):
+        return sum(1 for _ in forms)
+
+    start = time.perf_counter()
+    count(scheme.parse_all(scheme.lex(source)))
+    elapsed = time.perf_counter() - start
+    print(f"parse {len(source) / 1e6:.0f} MB string: "
+          f"{len(source) / elapsed / 1e6:.2f} MB/s")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "source.scm")
+        with open(path, "w") as f:
+            f.write(source)
+        with open(path) as f:
+            start = time.perf_counter()
+            count(scheme.parse_all(scheme.lex_stream(f)))
+            elapsed = time.perf_counter() - start
+        print(f"parse {len(source) / 1e6:.0f} MB file:   "
+              f"{len(source) / elapsed / 1e6:.2f} MB/s")
+
+
+if __name__ == "__main__":
+    bench_fib()
+    bench_memo()
+    bench_profile()
+    bench_loop()
+    bench_list()
+    bench_parse()
+    bench_snapshot()
+    bench_pmap()
@@ -1,114 +1,872 @@
 """A small live-coded Scheme.
 
 Because this was live-coded, it has a number of flaws (mostly related to
-sloppy handling of scope (e.g. all variables are global)) and many
-missing parts (e.g. no macros, no unquote, etc).
+sloppy handling of scope (e.g. there are no nested scopes: a variable is
+either an argument of the running function or global)) and many missing
+parts (e.g. no macros, no lambda, no unquote, etc).
 """
+from array import array
+from collections import Counter, OrderedDict
+import multiprocessing
+import os
+import pickle
+import re
+import time
+
+TOKEN = re.compile(r"[()]|[^\s()]+")
 
 
 def lex(ss):
-    current = ""
-    for char in ss:
-        if char in "()":
-            if current:
-                yield current
-            current = ""
-            yield char
-        elif char in " \t\n":
-            if current:
-                yield current
-            current = ""
-        else:
-            current += char
-    if current:
-        yield current
+    for match in TOKEN.finditer(ss):
+        yield match.group()
 
 
-def parse(tokens):
-    output = []
-    level = 0
+def lex_stream(stream, chunksize=1 << 16):
+    """The tokens of a file-like stream, read chunksize characters at a time"""
+    partial = ""
+    while True:
+        chunk = stream.read(chunksize)
+        if not chunk:
+            break
+        tokens = TOKEN.findall(partial + chunk)
+        if chunk[-1] in "()" or chunk[-1].isspace():
+            partial = ""
+        else:
+            # The last token may carry on into the next chunk
+            partial = tokens.pop()
+        yield from tokens
+    if partial:
+        yield partial
 
-    def get(output, level):
-        x = output
-        for i in range(level):
-            x = x[-1]
-        return x
 
+def parse_all(tokens):
+    """Yield each top-level form in tokens as soon as it is complete"""
+    stack = []
     for token in tokens:
         if token == "(":
-            get(output, level).append([])
-            level += 1
+            stack.append([])
         elif token == ")":
-            level -= 1
+            if not stack:
+                raise SyntaxError("unexpected )")
+            form = stack.pop()
+            if stack:
+                stack[-1].append(form)
+            else:
+                yield form
+        elif stack:
+            stack[-1].append(token)
         else:
-            get(output, level).append(token)
-    return output[0]
+            yield token
+    if stack:
+        raise SyntaxError("unclosed (")
 
 
-class Context:
+def parse(tokens):
+    return next(parse_all(tokens))
+
+
+class Pair:
+    """A cons cell. Lists are chains of pairs ending in NIL, so they share
+    tails and cdr is O(1). A chain can also end in something else, as in
+    (cons 1 2), which makes it an improper list."""
+
+    __slots__ = ("car", "cdr")
+
+    def __init__(self, car, cdr):
+        self.car = car
+        self.cdr = cdr
+
+    def __iter__(self):
+        """The cars of the chain, up to NIL or an improper tail"""
+        pair = self
+        while isinstance(pair, Pair) and pair is not NIL:
+            yield pair.car
+            pair = pair.cdr
+
+    def end(self):
+        """What the chain ends in: NIL, unless it is an improper list"""
+        pair = self
+        while isinstance(pair, Pair) and pair is not NIL:
+            pair = pair.cdr
+        return pair
+
+    def __repr__(self):
+        items = [repr(car) for car in self]
+        tail = self.end()
+        if tail is not NIL:
+            items += [".", repr(tail)]
+        return "(" + " ".join(items) + ")"
+
+    def __reduce__(self):
+        # Pickle a chain as one list, so that long lists don't overflow the
+        # stack
+        cars = []
+        pair = self
+        while isinstance(pair, Pair) and pair is not NIL:
+            cars.append(pair.car)
+            pair = pair.cdr
+        return chain, (cars, pair)
+
+
+class Nil(Pair):
+    """The empty list"""
+
+    __slots__ = ()
+
     def __init__(self):
-        self.frames = []
+        pass
+
+    def __repr__(self):
+        return "()"
+
+    def __reduce__(self):
+        return "NIL"
+
+
+NIL = Nil()
+
+
+def chain(cars, cdr=NIL):
+    """The pairs holding each of cars in turn, ending in cdr"""
+    for car in reversed(cars):
+        cdr = Pair(car, cdr)
+    return cdr
+
+
+def from_list(xs):
+    """Python lists (possibly nested) as chains of pairs"""
+    if not isinstance(xs, list):
+        return xs
+    return chain([from_list(x) for x in xs])
+
+
+def to_list(xs):
+    """Chains of pairs (possibly nested) as Python lists. Improper lists
+    have no Python equivalent, so they are left as pairs."""
+    if not isinstance(xs, Pair) or xs.end() is not NIL:
+        return xs
+    return [to_list(x) for x in xs]
+
+
+class Frame:
+    """The values of one call's arguments"""
+
+    __slots__ = ("values",)
+
+    def __init__(self, values):
+        self.values = values
+
+
+class TailCall:
+    """A call left for the caller to make, so tail calls don't nest"""
+
+    __slots__ = ("body", "frame")
+
+    def __init__(self, body, frame):
+        self.body = body
+        self.frame = frame
+
+
+def trampoline(result):
+    """Make the calls result leaves until there is a value"""
+    while type(result) is TailCall:
+        result = result.body(result.frame)
+    return result
+
+
+# Bytecode opcodes. Every instruction is an (opcode, argument) pair.
+(
+    CONST,
+    GLOBAL,
+    LOCAL,
+    CAR,
+    CDR,
+    ADD,
+    SUB,
+    LESS,
+    EQUAL,
+    JUMP,
+    JUMP_IF_FALSE,
+    CALL,
+    TAIL_CALL,
+    RETURN,
+    DEFINE_VAR,
+    DEFINE_FUNC,
+    CONS,
+    IS_NULL,
+    COUNT,
+    PMAP,
+) = range(20)
+
+SPECIAL_FORMS = {
+    "quasiquote",
+    "car",
+    "cdr",
+    "null?",
+    "cons",
+    "+",
+    "-",
+    "<",
+    "=",
+    "if",
+    "define",
+    "define-memo",
+    "pmap",
+}
+
+
+class Code:
+    """Bytecode: an array of (opcode, argument) pairs and a constant pool,
+    for a function taking nargs arguments"""
+
+    __slots__ = ("ops", "consts", "nargs")
+
+    def __init__(self, ops, consts, nargs=0):
+        self.ops = ops
+        self.consts = consts
+        self.nargs = nargs
+
+
+class Compiler:
+    """Compiles the parsed form of an expression into Code.
+
+    If profiled, each special form is preceded by a COUNT instruction.
+    """
+
+    def __init__(self, profiled=False):
+        self.ops = array("i")
+        self.consts = []
+        self.profiled = profiled
+
+    def emit(self, op, arg=0):
+        self.ops.extend((op, arg))
+        return len(self.ops) - 1
+
+    def const(self, value):
+        self.consts.append(value)
+        return len(self.consts) - 1
+
+    def code(self, nargs=0):
+        self.emit(RETURN)
+        return Code(self.ops, self.consts, nargs)
+
+    def compile(self, expr, args=(), tail_position=False):
+        if not isinstance(expr, list):
+            try:
+                value = int(expr)
+            except ValueError:
+                if expr in args:
+                    self.emit(LOCAL, args.index(expr))
+                else:
+                    self.emit(GLOBAL, self.const(expr))
+                return
+            self.emit(CONST, self.const(value))
+            return
+
+        head = expr[0]
+        tail = expr[1:]
+
+        if self.profiled and head in SPECIAL_FORMS:
+            self.emit(COUNT, self.const(head))
+
+        if head == "quasiquote":
+            assert len(tail) == 1
+            self.emit(CONST, self.const(from_list(tail[0])))
+        elif head in {"car", "cdr", "null?"}:
+            assert len(tail) == 1
+            self.compile(tail[0], args)
+            self.emit({"car": CAR, "cdr": CDR, "null?": IS_NULL}[head])
+        elif head == "cons":
+            assert len(tail) == 2
+            for t in tail:
+                self.compile(t, args)
+            self.emit(CONS)
+        elif head == "pmap":
+            name, xs = tail
+            self.compile(xs, args)
+            self.emit(PMAP, self.const(name))
+        elif head == "+":
+            for t in tail:
+                self.compile(t, args)
+            self.emit(ADD, len(tail))
+        elif head in {"-", "<", "="}:
+            assert len(tail) == 2
+            for t in tail:
+                self.compile(t, args)
+            self.emit({"-": SUB, "<": LESS, "=": EQUAL}[head])
+        elif head == "if":
+            test, then, otherwise = tail
+            self.compile(test, args)
+            to_otherwise = self.emit(JUMP_IF_FALSE)
+            self.compile(then, args, tail_position)
+            to_end = self.emit(JUMP)
+            self.ops[to_otherwise] = len(self.ops)
+            self.compile(otherwise, args, tail_position)
+            self.ops[to_end] = len(self.ops)
+        elif head in {"define", "define-memo"}:
+            if not isinstance(tail[0], list):
+                assert head == "define"
+                name, value = tail
+                self.compile(value, args)
+                self.emit(DEFINE_VAR, self.const(name))
+                return
+
+            defun, body = tail
+            name, params = defun[0], defun[1:]
+            memoize = head == "define-memo"
+            self.emit(DEFINE_FUNC, self.const((name, params, body, memoize)))
+        else:
+            for t in tail:
+                self.compile(t, args)
+            call = TAIL_CALL if tail_position else CALL
+            self.emit(call, self.const((head, len(tail))))
+
+
+class Profiler:
+    """Call counts, inclusive and exclusive time per user function, and how
+    often each special form runs.
+
+    A tail call replaces its caller's frame, so its time is counted under
+    the caller's caller, as it would be on the stack.
+    """
+
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.calls = Counter()
+        self.inclusive = Counter()
+        self.exclusive = Counter()
+        self.forms = Counter()
+        # Exclusive time per call stack, for collapsed-stack output
+        self.stacks = Counter()
+
+        # The [name, start, time in callees] of each running call, and how
+        # many times each function is on the stack
+        self.running = []
+        self.active = Counter()
+
+    def enter(self, name):
+        self.calls[name] += 1
+        self.active[name] += 1
+        self.running.append([name, self.clock(), 0.0])
+
+    def exit(self):
+        name, start, children = self.running.pop()
+        elapsed = self.clock() - start
+        self.active[name] -= 1
+        # Only the outermost of recursive calls counts towards inclusive time
+        if not self.active[name]:
+            self.inclusive[name] += elapsed
+        self.exclusive[name] += elapsed - children
+        if self.running:
+            self.running[-1][2] += elapsed
+
+        stack = tuple(frame[0] for frame in self.running) + (name,)
+        self.stacks[stack] += elapsed - children
+
+    def count(self, head, closure):
+        """closure, counting each run as one of the special form head"""
+        forms = self.forms
+
+        def counted(env):
+            forms[head] += 1
+            return closure(env)
+
+        return counted
+
+    def hottest_forms(self, n=None):
+        return self.forms.most_common(n)
+
+    def collapsed(self):
+        """Lines of semicolon-separated stacks and their exclusive time in
+        microseconds, as taken by flamegraph.pl"""
+        for stack, elapsed in sorted(self.stacks.items()):
+            yield f"{';'.join(stack)} {round(elapsed * 1e6)}"
+
+    def report(self):
+        header = ("function", "calls", "inclusive", "exclusive")
+        lines = ["{:20} {:>10} {:>10} {:>10}".format(*header)]
+        for name, exclusive in self.exclusive.most_common():
+            lines.append(
+                f"{name:20} {self.calls[name]:10} "
+                f"{self.inclusive[name]:10.4f} {exclusive:10.4f}"
+            )
+        lines.append("")
+        lines.append(f"{'special form':20} {'count':>10}")
+        for head, count in self.hottest_forms():
+            lines.append(f"{head:20} {count:10}")
+        return "\n".join(lines)
+
+
+MISSING = object()
+SNAPSHOT_VERSION = 1
+
+
+class Context:
+    def __init__(self, memo_size=4096, processes=None):
         self.globals = {}
         self.funcs = {}
+        self.compiled = {}
+        self.bytecode = {}
+
+        # Results of functions defined with define-memo, least recently
+        # used first
+        self.memoized = set()
+        self.memo = OrderedDict()
+        self.memo_size = memo_size
+        self.memo_hits = 0
+        self.memo_misses = 0
+
+        self.profiler = None
+
+        # How many worker processes pmap uses, defaulting to one per core.
+        # With one, pmap runs in this process.
+        self.processes = processes
+
+    def run(self, s, engine="closure"):
+        """Evaluate every form in s, returning the value of the last.
+
+        engine is either "closure", which runs closures made by `analyze`,
+        or "vm", which compiles to bytecode and runs it with `execute`.
+        """
+        return self.run_forms(parse_all(lex(s)), engine)
+
+    def load(self, stream, engine="closure"):
+        """Evaluate every form in a file-like stream as it is read"""
+        return self.run_forms(parse_all(lex_stream(stream)), engine)
+
+    def run_forms(self, forms, engine="closure"):
+        if engine == "closure":
+            evaluate = self.eval
+        elif engine == "vm":
+            evaluate = self.eval_bytecode
+        else:
+            raise ValueError(f"unknown engine {engine!r}")
+
+        output = None
+        for form in forms:
+            output = evaluate(form)
+        return to_list(output)
+
+    def set_profiler(self, profiler):
+        """Profile with profiler from now on, or stop if it is None.
+
+        Code is instrumented when it is analyzed or compiled, so this drops
+        both caches.
+        """
+        self.profiler = profiler
+        self.compiled.clear()
+        self.bytecode.clear()
+
+    def pmap(self, name, xs, engine):
+        """The list of the user-defined function name applied to each of xs,
+        computed in a pool of worker processes.
+
+        Each worker gets its own Context with this one's globals and
+        functions, so name must not rely on side effects. Workers can't
+        start processes of their own, so a pmap inside one runs there.
+        """
+        assert len(self.funcs[name][0]) == 1
+        xs = list(xs)
+        processes = self.processes or os.cpu_count()
+        if processes == 1 or not xs:
+            call = self.call if engine == "closure" else self.execute_function
+            if name in self.memoized:
+                return chain([self.call_memoized(name, [x], call) for x in xs])
+            return chain([call(name, [x]) for x in xs])
+
+        chunksize = max(1, -(-len(xs) // (4 * processes)))
+        chunks = [
+            (name, xs[i : i + chunksize]) for i in range(0, len(xs), chunksize)
+        ]
+
+        state = (self.globals, self.funcs, self.memoized)
+        with multiprocessing.Pool(
+            processes, _init_worker, (state, engine)
+        ) as pool:
+            results = pool.map(_worker_map, chunks)
+        return chain([y for result in results for y in result])
+
+    def snapshot(self, path):
+        """Save the definitions, bytecode and memoized results to path.
+
+        Pairs hash by identity, and a restored pair is a new object, so
+        results for list arguments could never be hit again and are left
+        out.
+        """
+        memo = OrderedDict(
+            (key, output)
+            for key, output in self.memo.items()
+            if not any(
+                isinstance(value, Pair) and value is not NIL
+                for value in key[1]
+            )
+        )
+        state = {
+            "globals": self.globals,
+            "funcs": self.funcs,
+            "bytecode": self.bytecode,
+            "memoized": self.memoized,
+            "memo": memo,
+            "memo_size": self.memo_size,
+        }
+        with open(path, "wb") as f:
+            pickle.dump((SNAPSHOT_VERSION, state), f, pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def restore(cls, path):
+        """A Context loaded from a snapshot at path.
+
+        Closures can't be saved, so function bodies are re-analyzed on their
+        first call, as usual.
+
+        Snapshots are pickles, and loading a pickle can run arbitrary code,
+        so only restore snapshots from a trusted source.
+        """
+        with open(path, "rb") as f:
+            version, state = pickle.load(f)
+        if version != SNAPSHOT_VERSION:
+            raise ValueError(f"unsupported snapshot version {version}")
+
+        ctx = cls(state.pop("memo_size"))
+        ctx.__dict__.update(state)
+        return ctx
+
+    def define(self, name, args, body, memoize=False):
+        self.funcs[name] = (args, body)
+        self.compiled.pop(name, None)
+        self.bytecode.pop(name, None)
 
-    def run(self, s):
-        return self.eval(parse(lex(s)))
+        if name in self.memoized:
+            self.memoized.discard(name)
+            for key in [key for key in self.memo if key[0] == name]:
+                del self.memo[key]
+        if memoize:
+            self.memoized.add(name)
+
+    def call_memoized(self, name, values, call):
+        """The result of the memoized function name on values, using
+        call(name, values) to compute it on a miss.
+
+        A memoized call has to finish to store its result, so it is never
+        made as a tail call and recursion through it uses Python's stack.
+        """
+        key = (name, tuple(values))
+        output = self.memo.get(key, MISSING)
+        if output is MISSING:
+            self.memo_misses += 1
+            output = self.memo[key] = call(name, values)
+            if len(self.memo) > self.memo_size:
+                self.memo.popitem(last=False)
+        else:
+            self.memo_hits += 1
+            self.memo.move_to_end(key)
+        return output
 
     def get_var(self, name):
-        for frame in self.frames:
-            if name in frame:
-                return frame[name]
         return self.globals[name]
 
     def eval(self, expr):
+        return self.analyze(expr)(None)
+
+    def call(self, name, values):
+        return trampoline(self.body(name)(Frame(values)))
+
+    def body(self, name):
+        """The compiled body of the user-defined function name"""
+        try:
+            return self.compiled[name]
+        except KeyError:
+            args, body = self.funcs[name]
+            compiled = self.analyze(body, args, tail_position=True)
+            if self.profiler is not None:
+                compiled = self.profiled(name, compiled)
+            self.compiled[name] = compiled
+            return compiled
+
+    def profiled(self, name, body):
+        profiler = self.profiler
+
+        def run(frame):
+            profiler.enter(name)
+            try:
+                return body(frame)
+            finally:
+                profiler.exit()
+
+        return run
+
+    def analyze(self, expr, scope=(), tail_position=False):
+        """Turn expr into a closure that evaluates it in a Frame.
+
+        scope is the names of the arguments of the function expr is in.
+        Literals are parsed, special forms are resolved and arguments are
+        given their slot in the Frame once, here, so running the closure
+        again (e.g. a function body on every call) skips all of that.
+
+        If expr is in tail position, a call there returns a TailCall for the
+        caller's trampoline instead of making it, so tail-recursive loops
+        run in constant Python stack.
+        """
+        closure = self.analyze_form(expr, scope, tail_position)
+        if (
+            self.profiler is not None
+            and isinstance(expr, list)
+            and expr[0] in SPECIAL_FORMS
+        ):
+            closure = self.profiler.count(expr[0], closure)
+        return closure
+
+    def analyze_form(self, expr, scope, tail_position):
         if not isinstance(expr, list):
             try:
-                return int(expr)
+                value = int(expr)
             except ValueError:
-                return self.get_var(expr)
+                return self.analyze_var(expr, scope)
+            return lambda env: value
 
         head = expr[0]
         tail = expr[1:]
 
         if head == "quasiquote":
             assert len(tail) == 1
-            return tail[0]
-        elif head in {"car", "cdr"}:
+            value = from_list(tail[0])
+            return lambda env: value
+        elif head in {"car", "cdr", "null?"}:
             assert len(tail) == 1
-            xs = self.eval(tail[0])
-            assert isinstance(xs, list)
+            xs = self.analyze(tail[0], scope)
 
             if head == "car":
-                return xs[0]
+                return lambda env: xs(env).car
+            elif head == "cdr":
+                return lambda env: xs(env).cdr
             else:
-                return xs[1:]
+                return lambda env: xs(env) is NIL
+        elif head == "cons":
+            assert len(tail) == 2
+            x, xs = (self.analyze(t, scope) for t in tail)
+            return lambda env: Pair(x(env), xs(env))
+        elif head == "pmap":
+            name, xs = tail
+            xs = self.analyze(xs, scope)
+            return lambda env: self.pmap(name, xs(env), "closure")
         elif head == "+":
-            numbers = [int(self.eval(t)) for t in tail]
-            return sum(numbers)
-        elif head == "define":
+            numbers = [self.analyze(t, scope) for t in tail]
+            return lambda env: sum(int(n(env)) for n in numbers)
+        elif head in {"-", "<", "="}:
+            assert len(tail) == 2
+            x, y = (self.analyze(t, scope) for t in tail)
+
+            if head == "-":
+                return lambda env: x(env) - y(env)
+            elif head == "<":
+                return lambda env: x(env) < y(env)
+            else:
+                return lambda env: x(env) == y(env)
+        elif head == "if":
+            test, then, otherwise = tail
+            test = self.analyze(test, scope)
+            then = self.analyze(then, scope, tail_position)
+            otherwise = self.analyze(otherwise, scope, tail_position)
+            # Only false is false: 0 and () are true, as in Scheme
+            return lambda env: (
+                then(env) if test(env) is not False else otherwise(env)
+            )
+        elif head in {"define", "define-memo"}:
             if not isinstance(tail[0], list):
                 # Defining a variable
+                assert head == "define"
                 name, value = tail
-                self.globals[name] = self.eval(value)
-                return
+                value = self.analyze(value, scope)
+
+                def define(env):
+                    self.globals[name] = value(env)
+
+                return define
 
             # Defining a function
             defun, body = tail
             name, args = defun[0], defun[1:]
+            memoize = head == "define-memo"
 
-            self.funcs[name] = (args, body)
+            def define(env):
+                self.define(name, args, body, memoize)
+
+            return define
         else:
             # This must be a user-defined function
-            args, body = self.funcs[head]
-            values = [self.eval(t) for t in tail]
-            assert len(values) == len(args)
+            operands = [self.analyze(t, scope) for t in tail]
 
-            self.frames.insert(
-                0, {key: value for key, value in zip(args, values)}
-            )
-            output = self.eval(body)
-            self.frames = self.frames[1:]
-            return output
+            def call(env):
+                args, body = self.funcs[head]
+                values = [operand(env) for operand in operands]
+                assert len(values) == len(args)
+                if head in self.memoized:
+                    return self.call_memoized(head, values, self.call)
+                return trampoline(self.body(head)(Frame(values)))
+
+            def tail_call(env):
+                args, body = self.funcs[head]
+                values = [operand(env) for operand in operands]
+                assert len(values) == len(args)
+                if head in self.memoized:
+                    return self.call_memoized(head, values, self.call)
+                return TailCall(self.body(head), Frame(values))
+
+            return tail_call if tail_position else call
+
+    def analyze_var(self, name, scope):
+        if name not in scope:
+            return lambda env: self.get_var(name)
+
+        slot = scope.index(name)
+        return lambda env: env.values[slot]
+
+    def eval_bytecode(self, expr):
+        compiler = Compiler(self.profiler is not None)
+        compiler.compile(expr)
+        return self.execute(compiler.code())
+
+    def code(self, name):
+        """The bytecode of the user-defined function name"""
+        try:
+            return self.bytecode[name]
+        except KeyError:
+            args, body = self.funcs[name]
+            compiler = Compiler(self.profiler is not None)
+            compiler.compile(body, args, tail_position=True)
+            code = self.bytecode[name] = compiler.code(len(args))
+            return code
+
+    def execute_function(self, name, values):
+        if self.profiler is None:
+            return self.execute(self.code(name), values)
+
+        self.profiler.enter(name)
+        try:
+            return self.execute(self.code(name), values)
+        finally:
+            self.profiler.exit()
+
+    def execute(self, code, args=()):
+        """Run code with arguments args on a stack VM, with its own call
+        stack rather than Python's"""
+        ops, consts = code.ops, code.consts
+        pc = 0
+        local = list(args)
+        stack = []
+        push, pop = stack.append, stack.pop
+        calls = []
+        bytecode = self.bytecode
+        memoized = self.memoized
+        profiler = self.profiler
+
+        # The most common opcodes are checked first
+        while True:
+            op, arg = ops[pc], ops[pc + 1]
+            pc += 2
+
+            if op == LOCAL:
+                push(local[arg])
+            elif op == CONST:
+                push(consts[arg])
+            elif op == GLOBAL:
+                push(self.get_var(consts[arg]))
+            elif op == JUMP_IF_FALSE:
+                if pop() is False:
+                    pc = arg
+            elif op == CALL or op == TAIL_CALL:
+                name, count = consts[arg]
+                callee = bytecode.get(name) or self.code(name)
+                assert count == callee.nargs
+                if name in memoized:
+                    start = len(stack) - count
+                    values = stack[start:]
+                    del stack[start:]
+                    push(
+                        self.call_memoized(name, values, self.execute_function)
+                    )
+                    if op == TAIL_CALL:
+                        if not calls:
+                            return pop()
+                        if profiler is not None:
+                            profiler.exit()
+                        ops, consts, pc, local = calls.pop()
+                    continue
+                if op == CALL:
+                    calls.append((ops, consts, pc, local))
+                if profiler is not None:
+                    if op == TAIL_CALL:
+                        profiler.exit()
+                    profiler.enter(name)
+                # A tail call reuses the caller's place on the call stack
+                if count:
+                    local = stack[-count:]
+                    del stack[-count:]
+                else:
+                    local = []
+                ops, consts, pc = callee.ops, callee.consts, 0
+            elif op == RETURN:
+                if not calls:
+                    return pop()
+                if profiler is not None:
+                    profiler.exit()
+                ops, consts, pc, local = calls.pop()
+            elif op == SUB:
+                y = pop()
+                stack[-1] = stack[-1] - y
+            elif op == LESS:
+                y = pop()
+                stack[-1] = stack[-1] < y
+            elif op == EQUAL:
+                y = pop()
+                stack[-1] = stack[-1] == y
+            elif op == ADD:
+                start = len(stack) - arg
+                total = sum(int(n) for n in stack[start:])
+                del stack[start:]
+                push(total)
+            elif op == JUMP:
+                pc = arg
+            elif op == CAR:
+                stack[-1] = stack[-1].car
+            elif op == CDR:
+                stack[-1] = stack[-1].cdr
+            elif op == IS_NULL:
+                stack[-1] = stack[-1] is NIL
+            elif op == CONS:
+                xs = pop()
+                stack[-1] = Pair(stack[-1], xs)
+            elif op == DEFINE_VAR:
+                self.globals[consts[arg]] = pop()
+                push(None)
+            elif op == DEFINE_FUNC:
+                self.define(*consts[arg])
+                push(None)
+            elif op == PMAP:
+                stack[-1] = self.pmap(consts[arg], stack[-1], "vm")
+            elif op == COUNT:
+                if profiler is not None:
+                    profiler.forms[consts[arg]] += 1
+
+
+# The Context and calling convention of each pmap worker process
+_worker = None
+_worker_call = None
+
+
+def _init_worker(state, engine):
+    global _worker, _worker_call
+    _worker = Context(processes=1)
+    _worker.globals, _worker.funcs, _worker.memoized = state
+    if engine == "closure":
+        _worker_call = _worker.call
+    else:
+        _worker_call = _worker.execute_function
+
+
+def _worker_map(chunk):
+    name, xs = chunk
+    return [_worker_call(name, [x]) for x in xs]
 
 
 ctx = Context()
@@ -0,0 +1,221 @@
+import io
+
+import pytest
+
+import scheme
+
+FIB = "(define (fib n) (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2)))))"
+CADR = "(define (cadr x) (car (cdr x)))"
+
+engines = pytest.mark.parametrize("engine", ["closure", "vm"])
+
+
+@pytest.mark.parametrize("chunksize", [1, 2, 3])
+def test_lex_stream(chunksize):
+    # Tokens split across chunks come out whole
+    source = f"{FIB}\n(fib 10)  (car (quasiquote (ab cd)))x"
+    stream = io.StringIO(source)
+    tokens = list(scheme.lex_stream(stream, chunksize))
+    assert tokens == list(scheme.lex(source))
+
+
+def test_parse_all():
+    forms = scheme.parse_all(scheme.lex("(define x 1) x (f (g 1) ())"))
+    assert list(forms) == [["define", "x", "1"], "x", ["f", ["g", "1"], []]]
+
+    with pytest.raises(SyntaxError, match="unexpected"):
+        list(scheme.parse_all(scheme.lex("(f 1))")))
+    with pytest.raises(SyntaxError, match="unclosed"):
+        list(scheme.parse_all(scheme.lex("((f 1)")))
+
+
+@engines
+def test_load(engine):
+    ctx = scheme.Context()
+    stream = io.StringIO(f"{FIB}\n(define x 10)\n(fib x)\n")
+    assert ctx.load(stream, engine) == 55
+
+
+@engines
+def test_fib(engine):
+    ctx = scheme.Context()
+    ctx.run(FIB, engine)
+    assert ctx.run("(fib 15)", engine) == 610
+
+
+@engines
+def test_tail_loop(engine):
+    # Far deeper than Python's recursion limit
+    ctx = scheme.Context()
+    ctx.run(
+        "(define (sum n acc) (if (= n 0) acc (sum (- n 1) (+ acc n))))",
+        engine,
+    )
+    assert ctx.run("(sum 100000 0)", engine) == 5000050000
+
+
+@engines
+def test_lists(engine):
+    ctx = scheme.Context()
+    ctx.run(CADR, engine)
+    assert ctx.run("(cadr (quasiquote (1 2 3)))", engine) == "2"
+    assert ctx.run("(cdr (quasiquote (1 (2 3) ())))", engine) == [
+        ["2", "3"],
+        [],
+    ]
+    assert ctx.run("(cons 1 (quasiquote (2)))", engine) == [1, "2"]
+    assert ctx.run("(null? (cdr (quasiquote (1))))", engine) is True
+
+
+@engines
+def test_define(engine):
+    ctx = scheme.Context()
+    ctx.run("(define x 5) (define (f y) (g 1)) (define (g y) (+ x y))", engine)
+    assert ctx.run("(f 100)", engine) == 6
+    # Redefining a function replaces its cached body
+    ctx.run("(define (g y) (- x y))", engine)
+    assert ctx.run("(f 100)", engine) == 4
+
+
+@engines
+def test_define_memo(engine):
+    ctx = scheme.Context()
+    ctx.run(FIB.replace("define", "define-memo", 1), engine)
+    assert ctx.run("(fib 30)", engine) == 832040
+    assert (ctx.memo_hits, ctx.memo_misses) == (28, 31)
+    assert ctx.run("(fib 30)", engine) == 832040
+    assert (ctx.memo_hits, ctx.memo_misses) == (29, 31)
+
+    # Redefining a memoized function forgets its results
+    ctx.run("(define (fib n) n)", engine)
+    assert ctx.run("(fib 30)", engine) == 30
+    assert not ctx.memo
+
+
+@engines
+def test_pmap(engine):
+    ctx = scheme.Context(processes=2)
+    ctx.run(FIB, engine)
+    # Quoted atoms are symbols, so the numbers are put in from Python
+    ctx.globals["xs"] = scheme.from_list([1, 2, 3, 4, 5, 10])
+    assert ctx.run("(pmap fib xs)", engine) == [1, 1, 2, 3, 5, 55]
+
+
+@engines
+def test_nested_pmap(engine):
+    # A pmap inside a worker runs in that worker
+    ctx = scheme.Context(processes=2)
+    ctx.run("(define (inc x) (+ x 1))", engine)
+    ctx.run("(define (incs xs) (pmap inc xs))", engine)
+    ctx.globals["xss"] = scheme.from_list([[1, 2], [3], []])
+    assert ctx.run("(pmap incs xss)", engine) == [[2, 3], [4], []]
+
+
+@engines
+def test_pmap_in_process(engine, monkeypatch):
+    monkeypatch.setattr(scheme.multiprocessing, "Pool", None)
+    ctx = scheme.Context()
+    ctx.run("(define (inc x) (+ x 1))", engine)
+    assert ctx.run("(pmap inc (quasiquote ()))", engine) == []
+
+    ctx.processes = 1
+    ctx.globals["xs"] = scheme.from_list([1, 2])
+    assert ctx.run("(pmap inc xs)", engine) == [2, 3]
+
+
+@engines
+def test_snapshot(engine, tmp_path):
+    path = tmp_path / "image"
+    ctx = scheme.Context()
+    ctx.run(CADR, engine)
+    ctx.run(FIB.replace("define", "define-memo", 1), engine)
+    ctx.run("(define xs (quasiquote (1 2 3)))", engine)
+    ctx.run("(fib 20)", engine)
+    ctx.snapshot(path)
+
+    restored = scheme.Context.restore(path)
+    assert restored.run("(cadr xs)", engine) == "2"
+    assert restored.run("(fib 20)", engine) == 6765
+    assert (restored.memo_hits, restored.memo_misses) == (1, 0)
+
+
+def test_snapshot_memo(tmp_path):
+    # Results for list arguments can't be found again after a restore
+    path = tmp_path / "image"
+    ctx = scheme.Context()
+    ctx.run("(define-memo (first xs) (car xs)) (define-memo (id x) x)")
+    ctx.run("(first (quasiquote (1 2))) (id (quasiquote ())) (id 3)")
+    assert len(ctx.memo) == 3
+    ctx.snapshot(path)
+
+    restored = scheme.Context.restore(path)
+    assert list(restored.memo) == [("id", (scheme.NIL,)), ("id", (3,))]
+    assert restored.run("(id (quasiquote ()))") == []
+    assert restored.memo_hits == 1
+
+
+@engines
+def test_improper_list(engine):
+    ctx = scheme.Context()
+    pair = ctx.run("(cons 1 2)", engine)
+    assert repr(pair) == "(1 . 2)"
+    assert list(pair) == [1]
+    assert repr(ctx.run("(cons 1 (cons 2 3))", engine)) == "(1 2 . 3)"
+    assert ctx.run("(cdr (cons 1 2))", engine) == 2
+    assert ctx.run("(cons (cons 1 2) (quasiquote ()))", engine)[0].cdr == 2
+
+
+@engines
+def test_if(engine):
+    # Only false is false
+    ctx = scheme.Context()
+    assert ctx.run("(if 0 1 2)", engine) == 1
+    assert ctx.run("(if (quasiquote ()) 1 2)", engine) == 1
+    assert ctx.run("(if (< 2 1) 1 2)", engine) == 2
+
+
+@engines
+def test_profiler(engine):
+    ctx = scheme.Context()
+    ctx.run(FIB, engine)
+    ctx.run("(define (loop n) (if (= n 0) 0 (loop (- n 1))))", engine)
+    ctx.run("(define (g n) (+ (loop n) 1))", engine)
+    ctx.run("(define-memo (m n) (if (= n 0) 0 (m (- n 1))))", engine)
+    ctx.run("(fib 3)", engine)
+    assert ctx.compiled or ctx.bytecode
+
+    # Instrumenting drops the code made without it. The clock ticks once
+    # per reading, which is at every enter and exit.
+    profiler = scheme.Profiler(clock=iter(range(1000)).__next__)
+    ctx.set_profiler(profiler)
+    assert not ctx.compiled and not ctx.bytecode
+
+    assert ctx.run("(fib 3)", engine) == 2
+    # loop's tail calls each replace the last, under g
+    assert ctx.run("(g 2)", engine) == 1
+    # A memoized call in tail position is made as an ordinary call
+    assert ctx.run("(m 2)", engine) == 0
+    assert not profiler.running
+    assert not +profiler.active
+
+    assert profiler.calls == {"fib": 5, "g": 1, "loop": 3, "m": 3}
+    assert profiler.forms == {"if": 11, "<": 5, "+": 3, "-": 8, "=": 6}
+    # Recursive calls only count towards inclusive time once
+    assert profiler.inclusive == {"fib": 9, "g": 7, "loop": 3, "m": 5}
+    assert profiler.exclusive == {"fib": 9, "g": 4, "loop": 3, "m": 5}
+    assert list(profiler.collapsed()) == [
+        "fib 3000000",
+        "fib;fib 4000000",
+        "fib;fib;fib 2000000",
+        "g 4000000",
+        "g;loop 3000000",
+        "m 2000000",
+        "m;m 2000000",
+        "m;m;m 1000000",
+    ]
+
+    report = profiler.report().splitlines()
+    assert report[0].split() == ["function", "calls", "inclusive", "exclusive"]
+    assert report[1].split() == ["fib", "5", "9.0000", "9.0000"]
+    assert report[6].split() == ["special", "form", "count"]
+    assert report[7].split() == ["if", "11"]